@@ -1,27 +1,630 @@
+import json
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
+from urllib.parse import urlencode
+
 import requests
-from config import WEBHOOK_URL
+from requests.adapters import HTTPAdapter
+from config import (
+    WEBHOOK_URL,
+    BITRIX24_POOL_SIZE,
+    BITRIX24_CONNECT_TIMEOUT,
+    BITRIX24_READ_TIMEOUT,
+    BITRIX24_RATE_LIMIT,
+    BITRIX24_BURST,
+    BITRIX24_MAX_RETRIES,
+    BITRIX24_BACKOFF_BASE,
+    BITRIX24_BACKOFF_MAX,
+    BITRIX24_OPERATING_THRESHOLD,
+    BITRIX24_LIST_WORKERS,
+)
+from metrics import (
+    API_CALLS,
+    API_RETRIES,
+    API_BYTES,
+    API_LATENCY,
+    API_BATCH_COMMANDS,
+    API_CACHE_HITS,
+    current_check,
+)
+
+# Ошибки Bitrix24, означающие превышение лимитов портала
+THROTTLING_ERRORS = ('QUERY_LIMIT_EXCEEDED', 'OPERATION_TIME_LIMIT')
+
+# HTTP-статусы, при которых запрос можно безопасно повторить
+RETRYABLE_STATUSES = (429, 500, 502, 503, 504)
+
+# Суффиксы методов только для чтения: их можно повторять без побочных эффектов
+IDEMPOTENT_SUFFIXES = ('.get', '.list', '.fields')
+
+
+class Bitrix24Error(Exception):
+    """
+    Запрос к Bitrix24 не удалось выполнить даже после повторных попыток.
+    """
+
+
+class RateLimiter:
+    """
+    Token bucket для запросов к порталу: rate запросов в секунду с запасом burst.
+    Один экземпляр делят все потоки, поэтому суммарная нагрузка не превышает лимит портала.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Блокирует поток до появления свободного токена.
+        """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+
+                wait = self.paused_until - now
+                if wait <= 0:
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """
+        Приостанавливает выдачу токенов на seconds секунд и опустошает корзину,
+        чтобы после паузы запросы снова шли с базовой скоростью.
+        """
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0
+
+
+def is_idempotent(method, params=None):
+    """
+    Можно ли безопасно повторить вызов метода.
+    batch считается идемпотентным, если идемпотентны все его команды.
+    """
+    if method == 'batch':
+        commands = (params or {}).get('cmd', {}).values()
+        return all(is_idempotent(command.split('?', 1)[0]) for command in commands)
+    return method.endswith(IDEMPOTENT_SUFFIXES)
+
+
+class Bitrix24Client:
+    """
+    Клиент API Bitrix24 с общим пулом keep-alive соединений.
+    Одна сессия используется всеми проверками и потоками, поэтому TCP+TLS рукопожатие
+    выполняется один раз на соединение, а не на каждый запрос.
+    Запросы проходят через общий RateLimiter, при превышении лимитов портала
+    идемпотентные вызовы повторяются с экспоненциальной задержкой.
+    """
+
+    def __init__(self, webhook_url, pool_size=10, connect_timeout=5, read_timeout=30,
+                 rate=1.8, burst=40, max_retries=5, backoff_base=1.0, backoff_max=60.0,
+                 operating_threshold=400):
+        self.webhook_url = webhook_url
+        self.timeout = (connect_timeout, read_timeout)
+        self.limiter = RateLimiter(rate, burst)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.operating_threshold = operating_threshold
+
+        # Методы, для которых портал почти исчерпал лимит времени выполнения: method -> unix time сброса
+        self.blocked_methods = {}
+        self.blocked_lock = threading.Lock()
+
+        # pool_block=True: при исчерпании пула поток ждет свободное соединение,
+        # а не открывает новое одноразовое
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+
+        self.session = requests.Session()
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update({
+            'Accept-Encoding': 'gzip, deflate',
+            'Connection': 'keep-alive',
+        })
+
+    def call(self, method, params=None, http_method='GET'):
+        """
+        Вызов метода API Bitrix24 через общую сессию.
+        Возвращает None при ошибке запроса, как и раньше. Если портал продолжает
+        ограничивать запросы или отвечать повторяемой ошибкой (RETRYABLE_STATUSES)
+        после всех повторов, выбрасывает Bitrix24Error, чтобы проверка не приняла
+        отсутствие ответа за отсутствие данных.
+        """
+        url = f"{self.webhook_url}{method}"
+        attempts = self.max_retries + 1 if is_idempotent(method, params) else 1
+
+        for attempt in range(attempts):
+            self._wait_for_method(method)
+            self.limiter.acquire()
+
+            started = time.monotonic()
+            try:
+                if http_method == 'GET':
+                    response = self.session.get(url, params=params, timeout=self.timeout)
+                elif http_method == 'POST':
+                    response = self.session.post(url, json=params, timeout=self.timeout)
+                else:
+                    raise ValueError("Недопустимый метод HTTP.")
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as err:
+                API_CALLS.labels(method, current_check(), 'network_error').inc()
+                if attempt + 1 < attempts:
+                    API_RETRIES.labels(method, current_check(), 'network').inc()
+                    delay = self._backoff(attempt)
+                    print(f"Сетевая ошибка при вызове {method}: {err}. Повтор через {delay:.1f} с.")
+                    time.sleep(delay)
+                    continue
+                raise Bitrix24Error(f"Не удалось выполнить {method}: {err}") from err
+            except Exception as err:
+                print(f"Другая ошибка: {err}")
+                return None
+
+            API_LATENCY.labels(method).observe(time.monotonic() - started)
+            API_CALLS.labels(method, current_check(), str(response.status_code)).inc()
+            API_BYTES.labels(method, current_check()).inc(len(response.content))
+
+            error_code = self._error_code(response)
+            # QUERY_LIMIT_EXCEEDED, 429 и 503 означают переполнение общей корзины запросов портала
+            portal_throttled = error_code == 'QUERY_LIMIT_EXCEEDED' or response.status_code in (429, 503)
+            throttled = portal_throttled or error_code in THROTTLING_ERRORS
+
+            if throttled or response.status_code in RETRYABLE_STATUSES:
+                delay = self._backoff(attempt)
+                if attempt + 1 < attempts:
+                    API_RETRIES.labels(method, current_check(), error_code or str(response.status_code)).inc()
+                    print(f"Bitrix24 ограничил запрос {method} ({error_code or response.status_code}). "
+                          f"Повтор через {delay:.1f} с.")
+                    if portal_throttled:
+                        # Приостанавливаем все потоки, ожидание произойдет в acquire()
+                        self.limiter.pause(delay)
+                    else:
+                        time.sleep(delay)
+                    continue
+                if throttled:
+                    raise Bitrix24Error(f"Превышен лимит запросов к Bitrix24 при вызове {method}")
+                raise Bitrix24Error(f"Bitrix24 ответил {response.status_code} при вызове {method}")
+
+            try:
+                response.raise_for_status()
+                data = response.json()
+            except requests.exceptions.HTTPError as http_err:
+                print(f"HTTP ошибка: {http_err}")
+                print("Детали ошибки:", response.text)
+                return None
+            except Exception as err:
+                print(f"Другая ошибка: {err}")
+                return None
+
+            self._observe_time(method, data)
+            return data
+
+    def _backoff(self, attempt):
+        """
+        Экспоненциальная задержка с jitter, чтобы потоки не повторяли запросы одновременно.
+        """
+        delay = min(self.backoff_max, self.backoff_base * 2 ** attempt)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    @staticmethod
+    def _error_code(response):
+        """
+        Код ошибки Bitrix24 из тела ответа, если он есть.
+        """
+        if response.ok:
+            return None
+        try:
+            return response.json().get('error')
+        except ValueError:
+            return None
+
+    def _observe_time(self, method, data):
+        """
+        Читает поле time из ответа. Если суммарное время выполнения метода (operating)
+        приближается к лимиту портала, откладывает вызовы метода до operating_reset_at.
+        """
+        timing = data.get('time') if isinstance(data, dict) else None
+        if not timing:
+            return
+
+        operating = timing.get('operating') or 0
+        reset_at = timing.get('operating_reset_at')
+        if operating >= self.operating_threshold and reset_at:
+            with self.blocked_lock:
+                self.blocked_methods[method] = float(reset_at)
+            print(f"Метод {method} близок к лимиту времени выполнения ({operating:.0f} с), "
+                  f"вызовы отложены до сброса лимита.")
+
+    def _wait_for_method(self, method):
+        """
+        Ждет сброса лимита времени выполнения для метода, если он был исчерпан.
+        """
+        with self.blocked_lock:
+            reset_at = self.blocked_methods.get(method)
+        if reset_at is None:
+            return
+
+        wait = reset_at - time.time()
+        if wait > 0:
+            time.sleep(wait)
+        with self.blocked_lock:
+            self.blocked_methods.pop(method, None)
+
+    def close(self):
+        """
+        Закрывает все соединения пула.
+        """
+        self.session.close()
+
+
+# Общий клиент для всего приложения
+client = Bitrix24Client(
+    WEBHOOK_URL,
+    pool_size=BITRIX24_POOL_SIZE,
+    connect_timeout=BITRIX24_CONNECT_TIMEOUT,
+    read_timeout=BITRIX24_READ_TIMEOUT,
+    rate=BITRIX24_RATE_LIMIT,
+    burst=BITRIX24_BURST,
+    max_retries=BITRIX24_MAX_RETRIES,
+    backoff_base=BITRIX24_BACKOFF_BASE,
+    backoff_max=BITRIX24_BACKOFF_MAX,
+    operating_threshold=BITRIX24_OPERATING_THRESHOLD,
+)
+
+class RequestCache:
+    """
+    Кэш запросов к Bitrix24 на время одного запуска проверок.
+    Хранит ответы методов чтения по ключу (метод, нормализованные параметры)
+    и отдельные сущности (сделки, пользователи) по ID, чтобы каждая сущность
+    запрашивалась не более одного раза за запуск.
+    """
+
+    def __init__(self):
+        self.responses = {}
+        self.entities = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def make_key(method, params):
+        """
+        Ключ кэша: метод и параметры, сериализованные с сортировкой ключей.
+        """
+        return method, json.dumps(params or {}, sort_keys=True, default=str, ensure_ascii=False)
+
+    def get(self, key):
+        """
+        Возвращает (найдено, ответ) для ключа запроса.
+        """
+        with self.lock:
+            if key in self.responses:
+                self.hits += 1
+                return True, self.responses[key]
+            self.misses += 1
+            return False, None
+
+    def put(self, key, response):
+        with self.lock:
+            self.responses[key] = response
+
+    def get_entities(self, kind, ids):
+        """
+        Возвращает найденные в кэше сущности вида kind и список ID, которых в кэше нет.
+        """
+        with self.lock:
+            stored = self.entities.get(kind, {})
+            found = {}
+            missing = []
+            for entity_id in ids:
+                if str(entity_id) in stored:
+                    found[str(entity_id)] = stored[str(entity_id)]
+                else:
+                    missing.append(entity_id)
+            self.hits += len(found)
+            self.misses += len(missing)
+            return found, missing
+
+    def put_entities(self, kind, entities):
+        """
+        Сохраняет сущности вида kind: словарь ID -> данные.
+        """
+        with self.lock:
+            stored = self.entities.setdefault(kind, {})
+            for entity_id, data in entities.items():
+                stored[str(entity_id)] = data
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+# Кэш текущего запуска проверок. ContextVar, а не глобальная переменная: вебхук
+# в потоке Flask не должен получать данные, закэшированные проверками.
+_run_cache = ContextVar('bitrix24_run_cache', default=None)
+
+
+def get_run_cache():
+    """
+    Кэш текущего запуска или None, если запуск не активен.
+    """
+    return _run_cache.get()
+
+
+@contextmanager
+def run_cache():
+    """
+    Включает кэш запросов на время блока with и очищает его при выходе.
+    """
+    cache = RequestCache()
+    token = _run_cache.set(cache)
+    try:
+        yield cache
+    finally:
+        _run_cache.reset(token)
+        stats = cache.stats()
+        print(f"Кэш запросов Bitrix24: попаданий {stats['hits']}, промахов {stats['misses']}")
+
 
 def call_api(method, params=None, http_method='GET'):
     """
     Универсальная функция для вызова методов API Bitrix24.
+    Запросы выполняются через общий клиент с пулом соединений.
+    Во время запуска проверок ответы методов чтения берутся из кэша запуска.
     """
-    url = f"{WEBHOOK_URL}{method}"
+    cache = get_run_cache()
+    if cache is None or method == 'batch' or not is_idempotent(method, params):
+        return client.call(method, params=params, http_method=http_method)
 
-    try:
-        if http_method == 'GET':
-            response = requests.get(url, params=params)
-        elif http_method == 'POST':
-            response = requests.post(url, json=params)
+    key = RequestCache.make_key(method, params)
+    found, response = cache.get(key)
+    if found:
+        API_CACHE_HITS.labels(method, current_check()).inc()
+        return response
+
+    response = client.call(method, params=params, http_method=http_method)
+    if response is not None:
+        cache.put(key, response)
+    return response
+
+
+# Максимальное количество команд в одном запросе batch (ограничение Bitrix24)
+BATCH_LIMIT = 50
+
+
+def build_query(params, prefix=''):
+    """
+    Преобразует вложенные параметры в строку запроса в формате PHP (filter[ID][0]=1&...),
+    который Bitrix24 ожидает в командах batch.
+    """
+    pairs = []
+
+    def flatten(value, key):
+        if isinstance(value, dict):
+            for sub_key, sub_value in value.items():
+                flatten(sub_value, f"{key}[{sub_key}]" if key else str(sub_key))
+        elif isinstance(value, (list, tuple, set)):
+            for index, sub_value in enumerate(value):
+                flatten(sub_value, f"{key}[{index}]")
+        elif value is None:
+            pairs.append((key, ''))
+        else:
+            pairs.append((key, str(value)))
+
+    flatten(params or {}, prefix)
+    return urlencode(pairs)
+
+
+class BatchRequest:
+    """
+    Очередь вызовов API Bitrix24, отправляемых через метод batch.
+    Команды отправляются пачками по BATCH_LIMIT за один HTTP-запрос,
+    результаты и ошибки возвращаются по ключам команд.
+    """
+
+    def __init__(self, halt=False):
+        self.halt = halt
+        self._commands = {}
+
+    def add(self, key, method, params=None):
+        """
+        Добавляет команду в очередь под ключом key.
+        """
+        self._commands[str(key)] = (method, params or {})
+
+    def __len__(self):
+        return len(self._commands)
+
+    def execute(self):
+        """
+        Выполняет все команды очереди.
+        Возвращает два словаря: результаты по ключам и ошибки по ключам.
+        """
+        results = {}
+        errors = {}
+        keys = []
+
+        # Команды, ответы на которые уже есть в кэше запуска, не отправляются повторно
+        cache = get_run_cache()
+        for key, (method, params) in self._commands.items():
+            if cache is not None:
+                found, result = cache.get(RequestCache.make_key(method, params))
+                if found:
+                    API_CACHE_HITS.labels(method, current_check()).inc()
+                    results[key] = result
+                    continue
+            keys.append(key)
+
+        for i in range(0, len(keys), BATCH_LIMIT):
+            chunk = keys[i:i + BATCH_LIMIT]
+            cmd = {}
+            for key in chunk:
+                method, params = self._commands[key]
+                cmd[key] = f"{method}?{build_query(params)}"
+                API_BATCH_COMMANDS.labels(method, current_check()).inc()
+
+            data = call_api('batch', params={'halt': 1 if self.halt else 0, 'cmd': cmd}, http_method='POST')
+
+            if not data or 'result' not in data:
+                for key in chunk:
+                    errors[key] = "Ошибка при выполнении batch-запроса"
+                continue
+
+            # Пустые словари PHP сериализует в JSON как списки
+            chunk_results = data['result'].get('result') or {}
+            chunk_errors = data['result'].get('result_error') or {}
+            if isinstance(chunk_results, list):
+                chunk_results = {}
+            if isinstance(chunk_errors, list):
+                chunk_errors = {}
+
+            for key in chunk:
+                if key in chunk_errors:
+                    error = chunk_errors[key]
+                    if isinstance(error, dict):
+                        error = f"{error.get('error')}: {error.get('error_description', '')}"
+                    errors[key] = error
+                elif key in chunk_results:
+                    results[key] = chunk_results[key]
+                    if cache is not None:
+                        method, params = self._commands[key]
+                        cache.put(RequestCache.make_key(method, params), chunk_results[key])
+                else:
+                    # Команда не была выполнена (например, batch остановлен из-за halt)
+                    errors[key] = "Команда не выполнена"
+
+        return results, errors
+
+
+# Размер страницы списочных методов Bitrix24
+PAGE_SIZE = 50
+
+
+def extract_records(result):
+    """
+    Достает список записей из поля result списочного метода.
+    Большинство методов возвращают список, crm.stagehistory.list и crm.item.list - словарь с ключом items.
+    """
+    if isinstance(result, dict):
+        return result.get('items', [])
+    return result or []
+
+
+def iter_list(method, params=None, fast=False):
+    """
+    Генератор, постранично возвращающий записи списочного метода Bitrix24.
+
+    В обычном режиме страницы запрашиваются по смещению start/next.
+    В быстром режиме (fast=True) используется start=-1 и курсор по ID (>ID или <ID
+    в зависимости от order[ID]): портал не считает общее количество записей, и каждая
+    страница выбирается за O(1) независимо от глубины. Сортировка в этом режиме
+    возможна только по ID.
+
+    Если страницу получить не удалось, выбрасывает Bitrix24Error: прерванная выборка
+    не должна выглядеть как законченная.
+    """
+    params = dict(params or {})
+
+    if fast:
+        yield from _iter_list_by_id(method, params)
+        return
+
+    start = 0
+    while True:
+        params['start'] = start
+        data = call_api(method, params=params, http_method='POST')
+
+        if not data or 'result' not in data:
+            raise Bitrix24Error(f"Ошибка при получении данных методом {method}.")
+
+        yield from extract_records(data['result'])
+
+        # Если в ответе есть 'next', значит есть следующая страница
+        if 'next' in data:
+            start = data['next']
         else:
-            raise ValueError("Недопустимый метод HTTP.")
-        
-        response.raise_for_status()
-        data = response.json()
+            return
+
+
+def _iter_list_by_id(method, params):
+    """
+    Постраничная выборка с курсором по ID без подсчета общего количества (start=-1).
+    """
+    order = params.get('order') or {}
+    descending = str(order.get('ID', 'ASC')).upper() == 'DESC'
+    cursor_key = '<ID' if descending else '>ID'
+
+    params['order'] = {'ID': 'DESC' if descending else 'ASC'}
+    params['filter'] = dict(params.get('filter') or {})
+    params['start'] = -1
+
+    # ID нужен для курсора
+    select = params.get('select')
+    if select and 'ID' not in select and '*' not in select:
+        params['select'] = list(select) + ['ID']
+
+    while True:
+        data = call_api(method, params=params, http_method='POST')
+
+        if not data or 'result' not in data:
+            raise Bitrix24Error(f"Ошибка при получении данных методом {method}.")
+
+        records = extract_records(data['result'])
+        yield from records
+
+        if len(records) < PAGE_SIZE:
+            return
+
+        last_record = records[-1]
+        params['filter'][cursor_key] = last_record.get('ID', last_record.get('id'))
+
+
+def fetch_list_concurrent(method, params=None, max_workers=None):
+    """
+    Загружает все записи списочного метода, запрашивая страницы параллельно.
+    Первая страница возвращает total, после чего смещения остальных страниц известны заранее
+    и запрашиваются в max_workers потоков. Общий RateLimiter клиента удерживает суммарную
+    скорость в пределах лимита портала. Записи возвращаются в исходном порядке страниц.
+    Если хотя бы одну страницу получить не удалось, выбрасывает Bitrix24Error:
+    неполный список не должен выглядеть как полный.
+    """
+    params = dict(params or {})
+    max_workers = max_workers or BITRIX24_LIST_WORKERS
+
+    def fetch_page(start):
+        page_params = dict(params, start=start)
+        data = call_api(method, params=page_params, http_method='POST')
+        if not data or 'result' not in data:
+            raise Bitrix24Error(f"Ошибка при получении страницы {start} методом {method}.")
         return data
-    except requests.exceptions.HTTPError as http_err:
-        print(f"HTTP ошибка: {http_err}")
-        print("Детали ошибки:", response.text)
-        return None
-    except Exception as err:
-        print(f"Другая ошибка: {err}")
-        return None
+
+    first_page = fetch_page(0)
+
+    records = list(extract_records(first_page['result']))
+    if 'next' not in first_page:
+        return records
+
+    total = int(first_page.get('total', 0))
+    offsets = range(first_page['next'], total, PAGE_SIZE)
+
+    # Каждая страница выполняется в копии контекста вызывающего потока, чтобы видеть кэш запуска.
+    # Результаты собираются в порядке смещений независимо от порядка завершения запросов
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(copy_context().run, fetch_page, start) for start in offsets]
+        for future in futures:
+            records.extend(extract_records(future.result()['result']))
+
+    return records
@@ -1,3 +1,4 @@
+# Порядок импорта задает порядок проверок в реестре
 from .check_overdue_tasks import check_overdue_activities
 from .check_next_step_missing import check_next_step_missing
 from .check_deal_not_moved import check_deal_not_moved
@@ -5,4 +6,6 @@ from .check_contact_name_missing import check_contact_name_missing
 from .check_uncontacted_reassigned_client import check_uncontacted_clients
 from .check_contact_removal import check_contact_removal
 from .check_additional_phone import check_additional_phone_number
-from .check_missed_calls import check_missed_calls
\ No newline at end of file
+from .check_missed_calls import check_missed_calls
+from .executor import execute_checks, print_summary
+from .registry import register, Need, registered_checks, plan_checks
@@ -2,12 +2,17 @@ from datetime import datetime, timedelta
 import pytz
 from bitrix24_api import call_api
 from utils import *
+from .registry import register
 from sqlalchemy.orm import Session
 from database import get_db
+from config import CHECK_STATE_EXPIRY_DAYS
 
 
 TIMEZONE = pytz.timezone('Europe/Moscow')
 
+CHECK_NAME = 'check_additional_phone_number'
+
+@register(CHECK_NAME)
 def check_additional_phone_number():
     """
     Проверяет, внесен ли дополнительный номер клиента в течение одного часа после первого звонка клиенту.
@@ -15,124 +20,137 @@ def check_additional_phone_number():
     """
     print('[Проверка 7]')
     rows_to_add = []  # Для записи данных в Google Sheets
+    responsible_ids = []  # ID ответственных по строкам
 
     # Текущее время в часовом поясе Москвы
     current_time = datetime.now(TIMEZONE)
 
+    # Результаты по сделкам: сделки с окончательным результатом в следующих запусках не проверяются
+    states = {}
+
     # Создаем сессию базы данных
     db = next(get_db())
 
     try:
-        # Получаем все deal_id и время создания из all_created_deal
-        deals = db.query(AllCreatedDeal.deal_id, AllCreatedDeal.created_time).all()
+        # Получаем из all_created_deal только сделки, по которым результат еще не определен
+        deals = pending_deals(db, CHECK_NAME, AllCreatedDeal.created_time, timedelta(days=CHECK_STATE_EXPIRY_DAYS))
 
-        # Проверяем каждую сделку
+        # Получаем завершенные звонки по всем сделкам, упорядоченные по END_TIME
+        call_index = fetch_call_index([deal.deal_id for deal in deals], 'END_TIME', completed=True) if deals else None
+
+        # Отбираем сделки, у которых с момента первого звонка прошло больше часа
+        deal_ids_to_check = []
         for deal in deals:
             deal_id = deal.deal_id
-            created_time_str = deal.created_time
-            created_time = datetime.fromisoformat(created_time_str).astimezone(TIMEZONE)
-
-            # Получаем информацию о первом звонке
-            activity_params = {
-                "filter": {
-                    "OWNER_ID": deal_id,
-                    "OWNER_TYPE_ID": 2,  # Тип ID для сделки в Bitrix24
-                    "TYPE_ID": 2,  # Тип активности (2 = звонок в Bitrix24)
-                    "COMPLETED": "Y"  # Только завершенные звонки
-                },
-                "order": {
-                    "END_TIME": "ASC"  # Сортируем по времени завершения, чтобы получить первый звонок
-                },
-                "select": ["ID", "END_TIME"]
-            }
 
-            # Запрос на получение списка активностей
-            activities_response = call_api('crm.activity.list', activity_params, 'POST')
+            if call_index.has_error(deal_id):
+                print(f"Ошибка при запросе звонков по сделке {deal_id}.")
+                continue
+
+            first_call = call_index.first_after(deal_id)
 
             # Проверяем, был ли первый завершенный звонок
-            if activities_response and 'result' in activities_response and len(activities_response['result']) > 0:
+            if first_call:
                 # Получаем время первого звонка
-                first_call_time_str = activities_response['result'][0].get('END_TIME')
-                first_call_time = datetime.fromisoformat(first_call_time_str).astimezone(TIMEZONE)
+                first_call_time = first_call[0].astimezone(TIMEZONE)
 
                 # Проверяем, прошел ли час с момента первого звонка
                 if current_time - first_call_time > timedelta(hours=1):
-                    # Получаем данные о сделке с помощью call_api
-                    deal_params = {
-                        "id": deal_id
-                    }
-                    deal_response = call_api('crm.deal.get', deal_params)
-
-                    if deal_response and 'result' in deal_response:
-                        deal_info = deal_response['result']
-                        contact_id = deal_info.get('CONTACT_ID')
-                        responsible_id = deal_info.get('ASSIGNED_BY_ID')
-
-                        # Проверяем, есть ли контакт у сделки
-                        if contact_id:
-                            # Получение информации о контакте с помощью call_api
-                            contact_params = {
-                                "id": contact_id
-                            }
-                            
-                            # Запрос на получение информации о контакте
-                            contact_response = call_api('crm.contact.get', contact_params)
-
-                            # Проверка данных о контакте
-                            if contact_response and 'result' in contact_response:
-                                contact_info = contact_response['result']
-                                phones = contact_info.get('PHONE', [])
-
-                                # Проверяем количество номеров телефона
-                                if len(phones) > 1:
-                                    print(f"Сделка ID: {deal_id} имеет более одного номера телефона.")
-                                else:
-                                    print(f"Сделка ID: {deal_id} имеет только один номер телефона.")
-                                    print(f"Ответственный за сделку (ID): {responsible_id}")
-                                    
-                                    # Получаем имя ответственного
-                                    user_name = get_user_names([responsible_id]).get(responsible_id, f"ID {responsible_id}")
-                                    
-                                    # Формируем ссылку на сделку
-                                    deal_link = f"https://kubnov.bitrix24.ru/crm/deal/details/{deal_id}/"
-
-                                    # Формируем замечание для Google Sheets
-                                    remark = "Дополнительный номер не внесен в течение часа после первого звонка"
-                                    
-                                    # Формируем строку для записи в Google Sheets
-                                    row = [
-                                        datetime.now().strftime('%Y-%m-%d %H:%M:%S'),  # Текущая дата и время
-                                        "Program",
-                                        deal_id,
-                                        deal_info.get('TITLE', ""),  # Название сделки
-                                        deal_info.get('STAGE_ID', ""),  # Статус сделки
-                                        user_name,
-                                        deal_link,  # Ссылка на сделку
-                                        remark
-                                    ]
-                                    rows_to_add.append(row)
-                                    
-                                    # Вывод только важной информации о сделке
-                                    important_info = {
-                                        'ID': deal_info.get('ID'),
-                                        'Название': deal_info.get('TITLE'),
-                                        'Контакт': deal_info.get('CONTACT_ID'),
-                                        'Ответственный': user_name,
-                                        'Статус': deal_info.get('STAGE_ID')
-                                    }
-                                    print(f"Информация о сделке: {important_info}")
-                            else:
-                                print(f"Ошибка при запросе информации о контакте {contact_id}.")
-                        else:
-                            print(f"Контакт для сделки ID {deal_id} не найден.")
-                    else:
-                        print(f"Ошибка при запросе информации о сделке {deal_id}.")
+                    deal_ids_to_check.append(deal_id)
+                else:
+                    states[deal_id] = PENDING
             else:
+                states[deal_id] = PENDING
                 print(f"Для сделки ID {deal_id} не найден завершенный звонок.")
 
+        # Получаем данные о сделках одним запросом на каждые 50 сделок
+        deals_data = {}
+        if deal_ids_to_check:
+            deals_data = {str(deal['ID']): deal for deal in get_deal_data(deal_ids_to_check)}
+
+        # Получаем информацию о контактах одним запросом на каждые 50 контактов
+        contacts_data = {str(contact['ID']): contact for contact in get_contact_data([
+            deal_info.get('CONTACT_ID') for deal_info in deals_data.values()
+        ])}
+
+        # Получаем имена всех ответственных одним запросом
+        user_names = get_user_names([
+            deal_info.get('ASSIGNED_BY_ID') for deal_info in deals_data.values() if deal_info.get('ASSIGNED_BY_ID')
+        ])
+
+        for deal_id in deal_ids_to_check:
+            deal_info = deals_data.get(str(deal_id))
+
+            if not deal_info:
+                print(f"Ошибка при запросе информации о сделке {deal_id}.")
+                continue
+
+            contact_id = deal_info.get('CONTACT_ID')
+            responsible_id = deal_info.get('ASSIGNED_BY_ID')
+
+            # Проверяем, есть ли контакт у сделки
+            if not contact_id:
+                print(f"Контакт для сделки ID {deal_id} не найден.")
+                continue
+
+            # Проверка данных о контакте
+            contact_info = contacts_data.get(str(contact_id))
+            if not contact_info:
+                print(f"Ошибка при запросе информации о контакте {contact_id}.")
+                continue
+
+            phones = contact_info.get('PHONE') or []
+
+            # Проверяем количество номеров телефона
+            if len(phones) > 1:
+                print(f"Сделка ID: {deal_id} имеет более одного номера телефона.")
+                states[deal_id] = SATISFIED
+                continue
+
+            print(f"Сделка ID: {deal_id} имеет только один номер телефона.")
+            print(f"Ответственный за сделку (ID): {responsible_id}")
+
+            # Получаем имя ответственного
+            user_name = user_names.get(responsible_id, f"ID {responsible_id}")
+
+            # Формируем ссылку на сделку
+            deal_link = f"https://kubnov.bitrix24.ru/crm/deal/details/{deal_id}/"
+
+            # Формируем замечание для Google Sheets
+            remark = "Дополнительный номер не внесен в течение часа после первого звонка"
+
+            # Формируем строку для записи в Google Sheets
+            row = [
+                datetime.now().strftime('%Y-%m-%d %H:%M:%S'),  # Текущая дата и время
+                "Program",
+                deal_id,
+                deal_info.get('TITLE', ""),  # Название сделки
+                deal_info.get('STAGE_ID', ""),  # Статус сделки
+                user_name,
+                deal_link,  # Ссылка на сделку
+                remark
+            ]
+            rows_to_add.append(row)
+            responsible_ids.append(responsible_id)
+            states[deal_id] = FLAGGED
+
+            # Вывод только важной информации о сделке
+            important_info = {
+                'ID': deal_info.get('ID'),
+                'Название': deal_info.get('TITLE'),
+                'Контакт': deal_info.get('CONTACT_ID'),
+                'Ответственный': user_name,
+                'Статус': deal_info.get('STAGE_ID')
+            }
+            print(f"Информация о сделке: {important_info}")
+
         # Если есть строки для добавления в Google Sheets
         if rows_to_add:
-            write_to_sheet(rows_to_add)
+            report_findings(rows_to_add, responsible_ids)
+
+        # Состояния сохраняются после записи нарушений, чтобы flagged не терялся при ошибке записи
+        save_check_states(db, CHECK_NAME, states)
+        db.commit()
 
         print("Успешная проверка")
 
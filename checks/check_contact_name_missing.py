@@ -1,7 +1,9 @@
 from datetime import datetime, timedelta
+import pandas as pd
 import pytz
-from bitrix24_api import call_api
+from bitrix24_api import call_api, iter_list
 from utils import *
+from .registry import register
 
 from datetime import datetime, timedelta
 import pytz
@@ -30,25 +32,12 @@ def get_contacts_without_name():
         'select': ['ID', 'NAME', 'LAST_NAME', 'PHONE', 'ASSIGNED_BY_ID', 'CREATED_BY_ID']
     }
 
-    all_contacts = []
-    start = 0
+    # Получаем все контакты постранично (курсор по ID, без подсчета общего количества)
+    contacts = list(iter_list(CONTACTS_METHOD, params, fast=True))
 
-    while True:
-        params['start'] = start
-        data = call_api(CONTACTS_METHOD, params=params, http_method='POST')
-
-        if data and 'result' in data:
-            contacts = data['result']
-            all_contacts.extend(contacts)
-
-            if 'next' in data:
-                start = data['next']
-            else:
-                break
-        else:
-            break
-
-    return all_contacts
+    # Полученные контакты доступны другим проверкам через кэш запуска
+    cache_contacts(contacts)
+    return contacts
 
 
 def get_calls_for_contacts(contact_ids):
@@ -72,26 +61,35 @@ def get_calls_for_contacts(contact_ids):
         'select': ['ID', 'START_TIME', 'RESPONSIBLE_ID', 'COMMUNICATIONS']
     }
 
-    all_calls = []
-    start = 0
-    while True:
-        params['start'] = start
-        data = call_api(ACTIVITIES_METHOD, params=params, http_method='POST')
+    # Получаем звонки постранично; порядок по START_TIME нужен для поиска первого звонка
+    return list(iter_list(ACTIVITIES_METHOD, params))
+
 
-        if data and 'result' in data and data['result']:
-            activities = data['result']
-            all_calls.extend(activities)
+def evaluate_first_calls(contacts, calls, now):
+    """
+    Оценивает все контакты сразу, столбцами таблиц.
+    contacts - контакты без имени (ID, ASSIGNED_BY_ID, CREATED_BY_ID) с телефоном,
+    calls - звонки по контактам (contact_id, START_TIME).
+    Возвращает контакты, с первого звонка которым прошло более 3 часов.
+    ID контактов приводятся к int перед объединением таблиц.
+    """
+    contacts = contacts.assign(contact_key=contacts['ID'].astype(int))
+    calls = calls.assign(contact_key=calls['contact_id'].astype(int), start_time=parse_times(calls['START_TIME']))
+    invalid = calls['start_time'].isna()
+    for _, call in calls[invalid].iterrows():
+        print(f"Неверный формат даты для звонка контакта ID {call['contact_id']}: {call['START_TIME']}")
 
-            if 'next' in data:
-                start = data['next']
-            else:
-                break
-        else:
-            break
+    # Первый звонок каждому контакту
+    first_calls = calls[~invalid].groupby('contact_key', as_index=False)['start_time'].min()
 
-    return all_calls
+    frame = contacts.merge(first_calls, on='contact_key')
+    since_first_call = to_timestamp(now) - frame['start_time']
 
+    mask = since_first_call > pd.Timedelta(hours=3)
+    return frame.assign(hours_since_first_call=since_first_call.dt.total_seconds() / 3600)[mask]
 
+
+@register('check_contact_name_missing')
 def check_contact_name_missing():
     """
     Проверка контактов, у которых не заполнено имя клиента и прошло более 3 часов с момента первого звонка.
@@ -110,59 +108,46 @@ def check_contact_name_missing():
     # Получаем все звонки для контактов за последние 24 часа
     calls = get_calls_for_contacts(contact_ids)
 
-    # Группируем звонки по контактам
-    calls_by_contact = {}
-    for call in calls:
-        communications = call.get('COMMUNICATIONS', [])
-        for comm in communications:
-            if comm.get('ENTITY_TYPE_ID') == '3':  # Контакты
-                contact_id = comm.get('ENTITY_ID')
-                if contact_id not in calls_by_contact:
-                    calls_by_contact[contact_id] = []
-                calls_by_contact[contact_id].append(call)
-
-    contacts_to_notify = []
+    # Звонки по контактам: по строке на каждую пару звонок - контакт
+    call_rows = [
+        {'contact_id': comm.get('ENTITY_ID'), 'START_TIME': call.get('START_TIME')}
+        for call in calls
+        for comm in call.get('COMMUNICATIONS') or []
+        if comm.get('ENTITY_TYPE_ID') == '3'  # Контакты
+    ]
+
     rows_to_add = []  # Для записи данных в Google Sheets
+    responsible_ids = []  # ID ответственных по строкам
 
     timezone = pytz.timezone('Europe/Moscow')
     now = datetime.now(timezone)
 
-    for contact in contacts:
-        contact_id = contact['ID']
-        phone_numbers = contact.get('PHONE', [])
-
-        # Пропускаем контакт, если нет номера телефона
-        if not phone_numbers:
-            continue
-
-        assigned_by_id = contact.get('ASSIGNED_BY_ID')
-        created_by_id = contact.get('CREATED_BY_ID')
-
-        # Ищем первый исходящий звонок для контакта
-        contact_calls = calls_by_contact.get(contact_id, [])
-        if contact_calls:
-            first_call = contact_calls[0]  # Звонки уже отсортированы по времени
-            first_call_time_str = first_call.get('START_TIME')
-
-            try:
-                first_call_time = datetime.strptime(first_call_time_str, '%Y-%m-%dT%H:%M:%S%z')
-                time_since_first_call = now - first_call_time.astimezone(timezone)
-
-                if time_since_first_call > timedelta(hours=3):
-                    contacts_to_notify.append({
-                        'contact_id': contact_id,
-                        'phone_numbers': [phone['VALUE'] for phone in phone_numbers],
-                        'first_call_time': first_call_time.strftime('%Y-%m-%d %H:%M:%S'),
-                        'hours_since_first_call': time_since_first_call.total_seconds() / 3600,
-                        'assigned_by_id': assigned_by_id,
-                        'created_by_id': created_by_id
-                    })
-            except ValueError:
-                print(f"Неверный формат даты для звонка контакта ID {contact_id}: {first_call_time_str}")
-                continue
-        else:
-            # Если звонков не было, пропускаем контакт
-            continue
+    # Контакты без номера телефона пропускаем
+    phones = {contact['ID']: contact['PHONE'] for contact in contacts if contact.get('PHONE')}
+
+    to_notify = evaluate_first_calls(
+        to_frame([contact for contact in contacts if contact['ID'] in phones], ['ID', 'ASSIGNED_BY_ID', 'CREATED_BY_ID']),
+        to_frame(call_rows, ['contact_id', 'START_TIME']),
+        now,
+    )
+
+    contacts_to_notify = [
+        {
+            'contact_id': contact_id,
+            'phone_numbers': [phone['VALUE'] for phone in phones[contact_id]],
+            'first_call_time': first_call_time,
+            'hours_since_first_call': hours_since_first_call,
+            'assigned_by_id': assigned_by_id,
+            'created_by_id': created_by_id
+        }
+        for contact_id, first_call_time, hours_since_first_call, assigned_by_id, created_by_id in zip(
+            to_notify['ID'],
+            local_strings(to_notify['start_time']),
+            to_notify['hours_since_first_call'],
+            to_notify['ASSIGNED_BY_ID'],
+            to_notify['CREATED_BY_ID'],
+        )
+    ]
 
     print(f"Контактов без имени, у которых прошло более 3 часов с момента первого звонка: {len(contacts_to_notify)}")
 
@@ -212,12 +197,13 @@ def check_contact_name_missing():
                 remark
             ]
             rows_to_add.append(row)
+            responsible_ids.append(assigned_by_id)
     else:
         print("Нет контактов, соответствующих условиям.")
 
     # Если есть строки для добавления в Google Sheets
     if rows_to_add:
-        write_to_sheet(rows_to_add)
+        report_findings(rows_to_add, responsible_ids, entity_type='contact')
 
     # Возвращаем список для дальнейшей обработки, если потребуется
     return contacts_to_notify
@@ -1,8 +1,10 @@
 from datetime import datetime
 from bitrix24_api import call_api
 from utils import *
+from .registry import register
 from database import get_db
 
+@register('check_contact_removal')
 def check_contact_removal():
     """
     Проверка удаления контактов из сделок. Если контакт удален, выводит данные о сделке и ответственном,
@@ -27,6 +29,7 @@ def check_contact_removal():
             deals_data = {str(deal['ID']): deal for deal in deals_data_list}  # Convert deal['ID'] to string
 
         rows_to_add = []  # Для записи данных в Google Sheets
+        responsible_ids = []  # ID ответственных по строкам
         
         # Проверяем данные по каждой сделке
         for deal in deals:
@@ -60,10 +63,11 @@ def check_contact_removal():
                     "Контакт был удален из сделки"
                 ]
                 rows_to_add.append(row)
+                responsible_ids.append(responsible_id)
 
         # Записываем данные в Google Sheets
         if rows_to_add:
-            write_to_sheet(rows_to_add)
+            report_findings(rows_to_add, responsible_ids)
 
         # Если проверка завершена успешно, выводим сообщение
         print("Успешная проверка")
@@ -1,14 +1,14 @@
 from datetime import datetime, timedelta
+import pandas as pd
 import pytz
-from bitrix24_api import call_api
+from bitrix24_api import call_api, iter_list
 from utils import *
+from .registry import register, Need
 
-def get_deals_with_recent_activities():
+def recent_activities_filter():
     """
-    Функция для получения сделок, в которых последнее действие завершено не раньше 3 дней назад и не позже 6 часов назад.
+    Фильтр завершенных дел по сделкам с END_TIME не раньше 3 дней назад и не позже 6 часов назад.
     """
-    ACTIVITIES_METHOD = 'crm.activity.list'
-
     # Текущее время и фильтры по времени
     timezone = pytz.timezone('Europe/Moscow')
     now = datetime.now(timezone)
@@ -19,42 +19,27 @@ def get_deals_with_recent_activities():
     three_days_ago_str = three_days_ago.strftime('%Y-%m-%dT%H:%M:%S%z')
     six_hours_ago_str = six_hours_ago.strftime('%Y-%m-%dT%H:%M:%S%z')
 
-    # Параметры запроса для завершенных активностей (дел) за последние 3 дня и до 6 часов назад
-    params = {
-        'filter': {
-            'COMPLETED': 'Y',      # Завершенные дела
-            '>=END_TIME': three_days_ago_str,  # Не раньше чем 3 дня назад
-            '<=END_TIME': six_hours_ago_str,   # Не позже чем 6 часов назад
-            'OWNER_TYPE_ID': 2,    # Сделка
-            'TYPE_ID': 6,          # Соответствует задаче (TASK)
-        },
-        'select': ['ID', 'SUBJECT', 'RESPONSIBLE_ID', 'OWNER_ID', 'OWNER_TYPE_ID', 'END_TIME', 'LAST_UPDATED']
+    # Завершенные активности (дела) за последние 3 дня и до 6 часов назад
+    return {
+        'COMPLETED': 'Y',      # Завершенные дела
+        '>=END_TIME': three_days_ago_str,  # Не раньше чем 3 дня назад
+        '<=END_TIME': six_hours_ago_str,   # Не позже чем 6 часов назад
+        'OWNER_TYPE_ID': 2,    # Сделка
+        'TYPE_ID': 6,          # Соответствует задаче (TASK)
     }
 
-    all_activities = []
-    start = 0
-
-    while True:
-        params['start'] = start
-        data = call_api(ACTIVITIES_METHOD, params=params, http_method='POST')
-        if data and 'result' in data and data['result']:
-            activities = data['result']
-            all_activities.extend(activities)
 
-            if 'next' in data:
-                start = data['next']
-            else:
-                break
-        else:
-            print("Ошибка при получении завершенных активностей.")
-            break
-
-    return all_activities
+def get_deals_with_recent_activities():
+    """
+    Функция для получения сделок, в которых последнее действие завершено не раньше 3 дней назад и не позже 6 часов назад.
+    """
+    return query_activities(recent_activities_filter())
 
 
 def get_stage_changes_for_deals(deal_ids):
     """
     Получает историю изменений стадии для всех сделок из списка deal_ids.
+    Записи возвращаются генератором по мере загрузки страниц.
     """
     STAGE_HISTORY_METHOD = 'crm.stagehistory.list'
 
@@ -72,35 +57,64 @@ def get_stage_changes_for_deals(deal_ids):
         'select': ['OWNER_ID', 'STAGE_ID', 'CREATED_TIME']
     }
 
-    all_stage_changes = []
-    start = 0
-
-    while True:
-        params['start'] = start
-        data = call_api(STAGE_HISTORY_METHOD, params=params, http_method='POST')
-
-        # Проверяем, что ответ содержит ключи 'result' и 'items'
-        if data and 'result' in data and 'items' in data['result']:
-            stage_changes = data['result']['items']  # Извлекаем элементы из 'items'
-            all_stage_changes.extend(stage_changes)
+    # Получаем историю стадий постранично от новых изменений к старым (курсор по ID)
+    return iter_list(STAGE_HISTORY_METHOD, params, fast=True)
 
-            if 'next' in data:
-                start = data['next']
-            else:
-                break
-        else:
-            print("Ошибка при получении истории стадий сделок.")
-            break
 
-    return all_stage_changes
+def evaluate_deals_not_moved(activities, stage_changes, now):
+    """
+    Оценивает все дела сразу, столбцами таблиц.
+    activities - дела (OWNER_ID, END_TIME, RESPONSIBLE_ID), stage_changes - история стадий
+    (OWNER_ID, CREATED_TIME) от новых изменений к старым.
+    Возвращает дела, после завершения которых прошло более 6 часов, а стадия сделки с тех пор не менялась.
+    OWNER_ID дел - строки (локальная таблица), истории стадий - числа (ответ API), поэтому
+    таблицы объединяются по приведенному к int столбцу deal_id.
+    """
+    stage_changes = stage_changes.assign(
+        deal_id=stage_changes['OWNER_ID'].astype(int),
+        last_stage_change_time=parse_times(stage_changes['CREATED_TIME']),
+    )
+    invalid = stage_changes['last_stage_change_time'].isna()
+    for _, change in stage_changes[invalid].iterrows():
+        print(f"Неверный формат даты для сделки ID {change['OWNER_ID']}: {change['CREATED_TIME']}")
+
+    # Последнее изменение стадии - первая запись сделки (история упорядочена от новых к старым)
+    last_changes = stage_changes[~invalid].drop_duplicates('deal_id', keep='first')[['deal_id', 'last_stage_change_time']]
+
+    activities = activities.assign(
+        deal_id=activities['OWNER_ID'].astype(int),
+        end_time=parse_times(activities['END_TIME']),
+    )
+    invalid = activities['end_time'].isna()
+    for _, activity in activities[invalid].iterrows():
+        print(f"Неверный формат даты для активности по сделке ID {activity['OWNER_ID']}: {activity['END_TIME']}")
+
+    # Дела сделок, у которых есть изменения стадии
+    frame = activities[~invalid].merge(last_changes, on='deal_id')
+    since_completion = to_timestamp(now) - frame['end_time']
+
+    mask = (since_completion > pd.Timedelta(hours=6)) & (frame['last_stage_change_time'] < frame['end_time'])
+    return frame.assign(hours_since_completion=since_completion.dt.total_seconds() / 3600)[mask]
+
+
+def activity_deal_ids(inputs):
+    """
+    ID сделок подготовленных для проверки дел: по ним планировщик загружает историю стадий.
+    """
+    return [activity['OWNER_ID'] for activity in inputs['activities']]
 
 
-def check_deal_not_moved():
+@register('check_deal_not_moved', needs={
+    'activities': Need('activity', recent_activities_filter),
+    'stage_changes': Need('stage_history', activity_deal_ids),
+})
+def check_deal_not_moved(activities=None, stage_changes=None):
     """
     Проверка сделок, которые не были переведены по воронке в течение 6 часов после завершения последнего действия.
     Записывает ссылку и статус сделки в CRM таблицу.
     """
-    activities = get_deals_with_recent_activities()
+    if activities is None:
+        activities = get_deals_with_recent_activities()
     print(f"[Проверка 3] Сделок с завершенными активностями за последние 3 дня до 6 часов назад: {len(activities)}")
 
     if not activities:
@@ -109,55 +123,39 @@ def check_deal_not_moved():
 
     deal_ids = [activity['OWNER_ID'] for activity in activities]
 
-    # Получаем изменения стадии для всех сделок
-    stage_changes = get_stage_changes_for_deals(deal_ids)
+    # Получаем изменения стадии для всех сделок, если их не загрузил планировщик
+    if stage_changes is None:
+        stage_changes = get_stage_changes_for_deals(deal_ids)
 
-    deals_not_moved = []
     rows_to_add = []  # Для записи данных в Google Sheets
+    responsible_ids = []  # ID ответственных по строкам
 
     timezone = pytz.timezone('Europe/Moscow')
     now = datetime.now(timezone)
 
-    # Преобразуем список изменений стадий в словарь по deal_id для быстрого доступа
-    last_stage_change_by_deal = {}
-    for change in stage_changes:
-        deal_id = change['OWNER_ID']
-        last_stage_change_time_str = change['CREATED_TIME']
-        try:
-            last_stage_change_time = datetime.strptime(last_stage_change_time_str, '%Y-%m-%dT%H:%M:%S%z')
-            if deal_id not in last_stage_change_by_deal:
-                last_stage_change_by_deal[deal_id] = last_stage_change_time
-        except ValueError:
-            print(f"Неверный формат даты для сделки ID {deal_id}: {last_stage_change_time_str}")
-
-    for activity in activities:
-        deal_id = activity['OWNER_ID']
-        end_time_str = activity['END_TIME']
-        responsible_id = activity['RESPONSIBLE_ID']
-
-        # Преобразуем END_TIME в datetime
-        try:
-            end_time = datetime.strptime(end_time_str, '%Y-%m-%dT%H:%M:%S%z')
-        except ValueError:
-            print(f"Неверный формат даты для активности по сделке ID {deal_id}: {end_time_str}")
-            continue
-
-        # Проверяем, было ли изменение стадии после последней активности
-        last_stage_change_time = last_stage_change_by_deal.get(deal_id)
-
-        if last_stage_change_time:
-            # Проверяем, прошло ли более 6 часов с момента завершения действия
-            time_since_last_activity = now - end_time.astimezone(timezone)
-
-            if time_since_last_activity > timedelta(hours=6) and last_stage_change_time < end_time:
-                # Если стадия не менялась после действия
-                deals_not_moved.append({
-                    'deal_id': deal_id,
-                    'responsible_id': responsible_id,
-                    'last_activity_time': end_time_str,
-                    'last_stage_change_time': last_stage_change_time.strftime('%Y-%m-%d %H:%M:%S'),
-                    'hours_since_completion': time_since_last_activity.total_seconds() / 3600
-                })
+    # Дела и история стадий в виде таблиц: даты разбираются целиком по столбцу
+    not_moved = evaluate_deals_not_moved(
+        to_frame(activities, ['OWNER_ID', 'END_TIME', 'RESPONSIBLE_ID']),
+        to_frame(stage_changes, ['OWNER_ID', 'CREATED_TIME']),
+        now,
+    )
+
+    deals_not_moved = [
+        {
+            'deal_id': deal_id,
+            'responsible_id': responsible_id,
+            'last_activity_time': end_time_str,
+            'last_stage_change_time': last_stage_change_time,
+            'hours_since_completion': hours_since_completion,
+        }
+        for deal_id, responsible_id, end_time_str, last_stage_change_time, hours_since_completion in zip(
+            not_moved['OWNER_ID'],
+            not_moved['RESPONSIBLE_ID'],
+            not_moved['END_TIME'],
+            local_strings(not_moved['last_stage_change_time']),
+            not_moved['hours_since_completion'],
+        )
+    ]
 
     print(f"Сделок, не переведенных по воронке в течение 6 часов после последнего действия: {len(deals_not_moved)}")
 
@@ -198,12 +196,13 @@ def check_deal_not_moved():
                 remark
             ]
             rows_to_add.append(row)
+            responsible_ids.append(item['responsible_id'])
     else:
         print("Все сделки были переведены по воронке в течение 6 часов после последнего действия.")
 
     # Если есть строки для добавления в Google Sheets
     if rows_to_add:
-        write_to_sheet(rows_to_add)
+        report_findings(rows_to_add, responsible_ids)
 
     # Возвращаем список для дальнейшей обработки, если потребуется
     return deals_not_moved
@@ -1,13 +1,51 @@
-from datetime import datetime
+from datetime import datetime, timedelta
+import numpy as np
+import pandas as pd
 import pytz
 from bitrix24_api import call_api
 from utils import *
+from .registry import register
 from sqlalchemy.orm import Session
 from database import get_db
+from config import CHECK_STATE_EXPIRY_DAYS
 
 
 TIMEZONE = pytz.timezone('Europe/Moscow')
 
+CHECK_NAME = 'check_missed_calls'
+
+
+def evaluate_calls(deals, calls):
+    """
+    Оценивает звонки всех сделок сразу, столбцами таблиц.
+    deals - таблица deal_id, fixed_time; calls - звонки (OWNER_ID, START_TIME, END_TIME).
+    Возвращает по каждой сделке со звонками после fixed_time: количество звонков, был ли успешный
+    звонок (более 20 секунд), требуемое количество неуспешных звонков и признак нарушения.
+    """
+    calls = calls.assign(
+        deal_id=calls['OWNER_ID'].astype(int),
+        start_time=parse_times(calls['START_TIME']),
+        end_time=parse_times(calls['END_TIME']),
+    ).merge(deals, on='deal_id')
+
+    # Учитываются только звонки после fixed_time сделки
+    calls = calls[calls['start_time'] >= calls['fixed_time']]
+    calls = calls.assign(successful=(calls['end_time'] - calls['start_time']).dt.total_seconds() > 20)
+
+    result = calls.groupby('deal_id').agg(
+        fixed_time=('fixed_time', 'first'),
+        calls=('successful', 'size'),
+        successful=('successful', 'any'),
+    )
+
+    # Сколько нужно неуспешных звонков, зависит от часа fixed_time по Москве
+    hours = local_hours(result['fixed_time'])
+    result['required'] = np.select([(hours >= 13) & (hours < 16), (hours >= 16) & (hours < 19)], [2, 1], default=3)
+    result['flagged'] = ~result['successful'] & (result['calls'] < result['required'])
+    return result
+
+
+@register(CHECK_NAME)
 def check_missed_calls():
     """
     Проверяет, есть ли успешные звонки (более 20 секунд) после fixed_time.
@@ -16,123 +54,115 @@ def check_missed_calls():
     """
     print('[Проверка 8]')
     rows_to_add = []  # Для записи данных в Google Sheets
+    responsible_ids = []  # ID ответственных по строкам
 
     # Текущее время в часовом поясе Москвы
     current_time = datetime.now(TIMEZONE)
 
+    # Результаты по сделкам: сделки с окончательным результатом в следующих запусках не проверяются
+    states = {}
+
     # Создаем сессию базы данных
     db = next(get_db())
 
     try:
-        # Получаем все deal_id и fixed_time из diff_assigment_id
-        deals = db.query(DiffAssignmentID.deal_id, DiffAssignmentID.fixed_time).all()
+        # Получаем из diff_assigment_id только сделки, по которым результат еще не определен
+        deals = pending_deals(db, CHECK_NAME, DiffAssignmentID.fixed_time, timedelta(days=CHECK_STATE_EXPIRY_DAYS))
 
-        # Проверяем каждую сделку
-        for deal in deals:
-            deal_id = deal.deal_id
-            fixed_time_str = deal.fixed_time
-            fixed_time = datetime.fromisoformat(fixed_time_str).astimezone(TIMEZONE)
-            assigned_by_id = None
-
-            # Получаем звонки, связанные со сделкой
-            activity_params = {
-                "filter": {
-                    "OWNER_ID": deal_id,
-                    "OWNER_TYPE_ID": 2,  # Тип ID для сделки в Bitrix24
-                    "TYPE_ID": 2,  # Тип активности (2 = звонок в Bitrix24)
-                    ">=START_TIME": fixed_time_str
-                },
-                "order": {
-                    "START_TIME": "ASC"
-                },
-                "select": ["ID", "START_TIME", "END_TIME"]
-            }
+        # Получаем звонки по всем сделкам начиная с самого раннего fixed_time, упорядоченные по START_TIME
+        call_index = None
+        if deals:
+            since = min(deal.fixed_time for deal in deals)
+            call_index = fetch_call_index([deal.deal_id for deal in deals], 'START_TIME', since=since)
+
+        # Сделки, по которым недостаточно неуспешных звонков
+        deal_ids_to_notify = []
 
-            activities_response = call_api('crm.activity.list', activity_params, 'POST')
-            
-            if activities_response and 'result' in activities_response:
-                calls = activities_response['result']
-
-                if not calls:  # Если нет звонков
-                    continue
-
-                successful_call = False
-                unsuccessful_calls = []
-
-                for call in calls:
-                    start_time = datetime.strptime(call['START_TIME'], '%Y-%m-%dT%H:%M:%S%z')
-                    end_time = datetime.strptime(call['END_TIME'], '%Y-%m-%dT%H:%M:%S%z')
-
-                    # Вычисляем длительность звонка в секундах
-                    call_duration_seconds = (end_time - start_time).total_seconds()
-
-                    # Проверяем успешность звонка (больше 20 секунд)
-                    if call_duration_seconds > 20:
-                        successful_call = True
-                        break
-                    else:
-                        unsuccessful_calls.append(call)
-
-                # Если успешного звонка нет
-                if not successful_call:
-                    # Определяем, сколько нужно неуспешных звонков
-                    required_unsuccessful_calls = 3
-                    if fixed_time.hour >= 13 and fixed_time.hour < 16:
-                        required_unsuccessful_calls = 2
-                    elif fixed_time.hour >= 16 and fixed_time.hour < 19:
-                        required_unsuccessful_calls = 1
-
-                    # Проверяем количество неуспешных звонков
-                    if len(unsuccessful_calls) < required_unsuccessful_calls:
-                        # Если не хватает неуспешных звонков, выводим информацию о сделке
-                        deal_response = call_api('crm.deal.get', {"id": deal_id}, 'POST')
-                        if deal_response and 'result' in deal_response:
-                            deal_info = deal_response['result']
-                            assigned_by_id = deal_info.get('ASSIGNED_BY_ID')
-
-                            # Получаем имя ответственного
-                            user_name = get_user_names([assigned_by_id]).get(assigned_by_id, f"ID {assigned_by_id}")
-                            
-                            # Формируем ссылку на сделку
-                            deal_link = f"https://kubnov.bitrix24.ru/crm/deal/details/{deal_id}/"
-
-                            # Формируем замечание для Google Sheets
-                            remark = "Недостаточно неуспешных звонков после фиксированного времени"
-                            
-                            # Формируем строку для записи в Google Sheets
-                            row = [
-                                datetime.now().strftime('%Y-%m-%d %H:%M:%S'),  # Текущая дата и время
-                                "Program",
-                                deal_id,
-                                deal_info.get('TITLE', ""),  # Название сделки
-                                deal_info.get('STAGE_ID', ""),  # Статус сделки
-                                user_name,
-                                deal_link,  # Ссылка на сделку
-                                remark
-                            ]
-                            rows_to_add.append(row)
-
-                            # Вывод только важной информации о сделке
-                            important_info = {
-                                'ID': deal_info.get('ID'),
-                                'Название': deal_info.get('TITLE'),
-                                'Контакт': deal_info.get('CONTACT_ID'),
-                                'Ответственный': user_name,
-                                'Статус': deal_info.get('STAGE_ID')
-                            }
-                            print(f"Информация о сделке: {important_info}")
-                    else:
-                        print(f"Сделка ID {deal_id} имеет достаточное количество неуспешных звонков: {len(unsuccessful_calls)}")
-                        print("Успешная проверка")
-                else:
-                    print(f"Сделка ID {deal_id} имеет успешный звонок.")
-                    print("Успешная проверка")
+        # Сделки, звонки по которым получить не удалось, остаются на следующий запуск
+        checked_deals = []
+        for deal in deals:
+            if call_index.has_error(deal.deal_id):
+                print(f"Не удалось получить данные о звонках для сделки ID {deal.deal_id}.")
             else:
-                print(f"Не удалось получить данные о звонках для сделки ID {deal_id}.")
+                checked_deals.append(deal)
+
+        calls = to_frame(call_index.all_calls(), ['OWNER_ID', 'START_TIME', 'END_TIME']) if call_index else None
+
+        # Сделки без звонков после fixed_time тоже остаются на следующий запуск
+        if checked_deals and not calls.empty:
+            deals_frame = pd.DataFrame({
+                'deal_id': [deal.deal_id for deal in checked_deals],
+                'fixed_time': pd.to_datetime([deal.fixed_time for deal in checked_deals], utc=True),
+            })
+            result = evaluate_calls(deals_frame, calls)
+
+            deal_ids_to_notify = [int(deal_id) for deal_id in result.index[result['flagged']]]
+            satisfied = result[~result['flagged']]
+            for deal_id in satisfied.index:
+                states[int(deal_id)] = SATISFIED
+            print(
+                f"Сделок с успешным звонком: {int(satisfied['successful'].sum())}, "
+                f"с достаточным количеством неуспешных звонков: {int((~satisfied['successful']).sum())}"
+            )
+
+        # Получаем данные о сделках и имена ответственных одним запросом
+        deals_data = {}
+        user_names = {}
+        if deal_ids_to_notify:
+            deals_data = {str(deal['ID']): deal for deal in get_deal_data(deal_ids_to_notify)}
+            user_names = get_user_names([
+                deal_info.get('ASSIGNED_BY_ID') for deal_info in deals_data.values() if deal_info.get('ASSIGNED_BY_ID')
+            ])
+
+        # Если не хватает неуспешных звонков, выводим информацию о сделке
+        for deal_id in deal_ids_to_notify:
+            deal_info = deals_data.get(str(deal_id))
+            if not deal_info:
+                continue
+
+            assigned_by_id = deal_info.get('ASSIGNED_BY_ID')
+
+            # Получаем имя ответственного
+            user_name = user_names.get(assigned_by_id, f"ID {assigned_by_id}")
+
+            # Формируем ссылку на сделку
+            deal_link = f"https://kubnov.bitrix24.ru/crm/deal/details/{deal_id}/"
+
+            # Формируем замечание для Google Sheets
+            remark = "Недостаточно неуспешных звонков после фиксированного времени"
+
+            # Формируем строку для записи в Google Sheets
+            row = [
+                datetime.now().strftime('%Y-%m-%d %H:%M:%S'),  # Текущая дата и время
+                "Program",
+                deal_id,
+                deal_info.get('TITLE', ""),  # Название сделки
+                deal_info.get('STAGE_ID', ""),  # Статус сделки
+                user_name,
+                deal_link,  # Ссылка на сделку
+                remark
+            ]
+            rows_to_add.append(row)
+            responsible_ids.append(assigned_by_id)
+            states[deal_id] = FLAGGED
+
+            # Вывод только важной информации о сделке
+            important_info = {
+                'ID': deal_info.get('ID'),
+                'Название': deal_info.get('TITLE'),
+                'Контакт': deal_info.get('CONTACT_ID'),
+                'Ответственный': user_name,
+                'Статус': deal_info.get('STAGE_ID')
+            }
+            print(f"Информация о сделке: {important_info}")
 
         # Если есть строки для добавления в Google Sheets
         if rows_to_add:
-            write_to_sheet(rows_to_add)
+            report_findings(rows_to_add, responsible_ids)
+
+        # Состояния сохраняются после записи нарушений, чтобы flagged не терялся при ошибке записи
+        save_check_states(db, CHECK_NAME, states)
+        db.commit()
 
         print("Успешная проверка")
 
@@ -1,14 +1,13 @@
 from datetime import datetime, timedelta
 import pytz
-from bitrix24_api import call_api
+from bitrix24_api import call_api, iter_list
 from utils import *
+from .registry import register, Need
 
-def get_completed_activities():
+def completed_activities_filter():
     """
-    Функция для получения завершенных дел (активностей) за последние 6 часов, где LAST_UPDATED не раньше чем 2 часа назад.
+    Фильтр завершенных дел (активностей) за последние 6 часов, где LAST_UPDATED не раньше чем 2 часа назад.
     """
-    ACTIVITIES_METHOD = 'crm.activity.list'
-
     # Текущее время и фильтры по времени
     timezone = pytz.timezone('Europe/Moscow')
     now = datetime.now(timezone)
@@ -19,87 +18,73 @@ def get_completed_activities():
     six_hours_ago_str = six_hours_ago.strftime('%Y-%m-%dT%H:%M:%S%z')
     two_hours_ago_str = two_hours_ago.strftime('%Y-%m-%dT%H:%M:%S%z')
 
-    # Параметры запроса: завершенные дела за последние 6 часов с фильтром по LAST_UPDATED
-    params = {
-        'filter': {
-            'COMPLETED': 'Y',      # Завершенные дела
-            '>=LAST_UPDATED': six_hours_ago_str,  # Обновленные не раньше чем 6 часов назад
-            '<=LAST_UPDATED': two_hours_ago_str,  # Обновленные не позже чем 2 часа назад
-            'OWNER_TYPE_ID': 2,    # Сделка
-            'TYPE_ID': 6,          # Соответствует задаче (TASK)
-        },
-        'select': ['ID', 'SUBJECT', 'RESPONSIBLE_ID', 'OWNER_ID', 'OWNER_TYPE_ID', 'END_TIME', 'LAST_UPDATED']
+    # Завершенные дела за последние 6 часов с фильтром по LAST_UPDATED
+    return {
+        'COMPLETED': 'Y',      # Завершенные дела
+        '>=LAST_UPDATED': six_hours_ago_str,  # Обновленные не раньше чем 6 часов назад
+        '<=LAST_UPDATED': two_hours_ago_str,  # Обновленные не позже чем 2 часа назад
+        'OWNER_TYPE_ID': 2,    # Сделка
+        'TYPE_ID': 6,          # Соответствует задаче (TASK)
+    }
+
+
+def new_deals_filter():
+    """
+    Фильтр новых сделок, созданных за последние 2 часа.
+    """
+    timezone = pytz.timezone('Europe/Moscow')
+    two_hours_ago = datetime.now(timezone) - timedelta(hours=2)
+
+    return {
+        '>=DATE_CREATE': two_hours_ago.strftime('%Y-%m-%dT%H:%M:%S%z'),  # Новые сделки, созданные за последние 2 часа
     }
 
-    all_activities = []
-    start = 0
 
-    while True:
-        params['start'] = start
-        data = call_api(ACTIVITIES_METHOD, params=params, http_method='POST')
-        if data and 'result' in data and data['result']:
-            activities = data['result']
-            all_activities.extend(activities)
+def get_new_deals():
+    """
+    Получает новые сделки, созданные за последние 2 часа, из Bitrix24.
+    """
+    params = {
+        'filter': new_deals_filter(),
+        'select': ['ID', 'TITLE', 'ASSIGNED_BY_ID', 'DATE_CREATE']
+    }
+
+    # Получаем новые сделки постранично (курсор по ID, без подсчета общего количества)
+    return list(iter_list('crm.deal.list', params, fast=True))
 
-            if 'next' in data:
-                start = data['next']
-            else:
-                break
-        else:
-            print("Ошибка при получении завершенных дел.")
-            break
 
-    return all_activities
+def get_completed_activities():
+    """
+    Функция для получения завершенных дел (активностей) за последние 6 часов, где LAST_UPDATED не раньше чем 2 часа назад.
+    """
+    return query_activities(completed_activities_filter())
 
 
-def check_next_step_missing():
+@register('check_next_step_missing', needs={
+    'completed_activities': Need('activity', completed_activities_filter),
+    'new_deals': Need('deal', new_deals_filter),
+})
+def check_next_step_missing(completed_activities=None, new_deals=None):
     """
     Функция проверяет ответственных за сделки завершенные за последние 6 часов,
     и сравнивает с теми, кто создал новые сделки за последние 2 часа.
     Также записывает ссылку на ответственного в CRM таблицу.
     """
     # Получаем завершенные дела за последние 6 часов
-    completed_activities = get_completed_activities()
+    if completed_activities is None:
+        completed_activities = get_completed_activities()
     print(f"[Проверка 2] Завершенных дел за последние 6 часов: {len(completed_activities)}")
 
     missing_next_steps = []
     rows_to_add = []  # Для записи данных в Google Sheets
+    responsible_ids = []  # ID ответственных по строкам
 
     # Извлекаем ответственных (responsible_id) из завершенных сделок
     responsible_ids_from_completed = {activity['RESPONSIBLE_ID'] for activity in completed_activities}
 
-    # Получаем текущее время и время 2 часа назад
-    timezone = pytz.timezone('Europe/Moscow')
-    now = datetime.now(timezone)
-    two_hours_ago = now - timedelta(hours=2)
-    two_hours_ago_str = two_hours_ago.strftime('%Y-%m-%dT%H:%M:%S%z')
-
-    # Параметры запроса для получения новых сделок, созданных за последние 2 часа
-    params = {
-        'filter': {
-            '>=DATE_CREATE': two_hours_ago_str,  # Новые сделки, созданные за последние 2 часа
-            'OWNER_TYPE_ID': 2,  # Сделка
-        },
-        'select': ['ID', 'TITLE', 'ASSIGNED_BY_ID', 'DATE_CREATE']
-    }
-
-    new_deals = []
-    start = 0
-
-    while True:
-        params['start'] = start
-        data = call_api('crm.deal.list', params=params, http_method='POST')
-        if data and 'result' in data and data['result']:
-            deals = data['result']
-            new_deals.extend(deals)
-
-            if 'next' in data:
-                start = data['next']
-            else:
-                break
-        else:
-            print("Ошибка при получении новых сделок.")
-            break
+    # Новые сделки за последние 2 часа: планировщик берет их из зеркала сделок
+    if new_deals is None:
+        new_deals = get_new_deals()
 
     print(f"[Проверка] Новых сделок за последние 2 часа: {len(new_deals)}")
 
@@ -146,12 +131,13 @@ def check_next_step_missing():
                 remark
             ]
             rows_to_add.append(row)
+            responsible_ids.append(item['responsible_id'])
     else:
         print("Все ответственные создали новые сделки за последние 2 часа.")
 
     # Если есть строки для добавления в Google Sheets
     if rows_to_add:
-        write_to_sheet(rows_to_add)
+        report_findings(rows_to_add, responsible_ids, entity_type=None)
 
     # Возвращаем список ответственных без новых сделок для дальнейшей обработки, если потребуется
     return missing_next_steps
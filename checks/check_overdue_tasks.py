@@ -2,13 +2,12 @@ from datetime import datetime, timedelta
 import pytz
 from bitrix24_api import call_api
 from utils import *
+from .registry import register, Need
 
-def get_overdue_activities():
+def overdue_activities_filter():
     """
-    Функция для получения дел (активностей) внутри сделок CRM, которые просрочены более чем на 1 час.
+    Фильтр незавершенных дел внутри сделок CRM, которые просрочены более чем на 1 час.
     """
-    ACTIVITIES_METHOD = 'crm.activity.list'
-
     # Определяем текущую дату и время, а также время час назад, используя часовой пояс Москвы
     timezone = pytz.timezone('Europe/Moscow')
     now = datetime.now(timezone)
@@ -17,50 +16,33 @@ def get_overdue_activities():
     # Приводим дату к строковому формату ISO 8601, чтобы использовать в фильтре
     one_hour_ago_str = one_hour_ago.strftime('%Y-%m-%dT%H:%M:%S%z')
 
-    # Параметры запроса для получения незавершенных дел с дедлайном больше чем час назад
-    params = {
-        'filter': {
-            'COMPLETED': 'N',  # Только незавершенные дела
-            '<=DEADLINE': one_hour_ago_str,  # С дедлайном раньше чем один час назад
-            'OWNER_TYPE_ID': 2,  # Тип объекта - сделка (2 соответствует сделке)
-            # В случае необходимости можно добавить фильтр по конкретной воронке
-        },
-        'select': ['ID', 'SUBJECT', 'DEADLINE', 'RESPONSIBLE_ID', 'CREATED', 'OWNER_ID', 'OWNER_TYPE_ID']
+    # Незавершенные дела с дедлайном больше чем час назад
+    return {
+        'COMPLETED': 'N',  # Только незавершенные дела
+        '<=DEADLINE': one_hour_ago_str,  # С дедлайном раньше чем один час назад
+        'OWNER_TYPE_ID': 2,  # Тип объекта - сделка (2 соответствует сделке)
+        # В случае необходимости можно добавить фильтр по конкретной воронке
     }
 
-    all_activities = []
-    start = 0
-
-    # Получаем все активности (постранично) пока не получим все
-    while True:
-        params['start'] = start
-        data = call_api(ACTIVITIES_METHOD, params=params, http_method='POST')
-        
-        # Проверяем наличие результатов в ответе
-        if data and 'result' in data and data['result']:
-            activities = data['result']
-            all_activities.extend(activities)
-
-            # Если в ответе есть 'next', значит есть следующая страница
-            if 'next' in data:
-                start = data['next']
-            else:
-                break  # Если 'next' нет, значит данные закончились
-        else:
-            print("Ошибка при получении дел.")
-            break
-
-    return all_activities
+def get_overdue_activities():
+    """
+    Функция для получения дел (активностей) внутри сделок CRM, которые просрочены более чем на 1 час.
+    """
+    # Дела читаются из локальной таблицы, которую заполняет синхронизация с Bitrix24
+    return query_activities(overdue_activities_filter())
 
-def check_overdue_activities():
+@register('check_overdue_activities', needs={'overdue_activities': Need('activity', overdue_activities_filter)})
+def check_overdue_activities(overdue_activities=None):
     """
     Проверка просроченных дел (активностей) внутри сделок и вывод результатов,
     запись ссылки и статуса сделки в CRM таблицу.
     """
-    overdue_activities = get_overdue_activities()
+    if overdue_activities is None:
+        overdue_activities = get_overdue_activities()
     print(f"[Проверка 1] Просроченных дел более чем на 1 час: {len(overdue_activities)}")
 
     rows_to_add = []  # Список строк для записи в Google Sheets
+    responsible_ids = []  # ID ответственных по строкам
 
     if overdue_activities:
         # Собираем ID всех ответственных пользователей
@@ -109,12 +91,13 @@ def check_overdue_activities():
                 remark
             ]
             rows_to_add.append(row)
+            responsible_ids.append(responsible_id)
     else:
         print("Нет просроченных дел.")
 
     # Если есть строки для добавления в Google Sheets
     if rows_to_add:
-        write_to_sheet(rows_to_add)
+        report_findings(rows_to_add, responsible_ids)
 
     # Возвращаем список просроченных дел, если потребуется для последующей обработки
     return overdue_activities
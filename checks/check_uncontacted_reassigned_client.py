@@ -2,48 +2,40 @@ from datetime import datetime, timedelta
 import pytz
 from bitrix24_api import call_api
 from utils import *
+from .registry import register
 from sqlalchemy.orm import Session
 from database import get_db
+from config import TRACKING_LOOKBACK_DAYS
 
 TIMEZONE = pytz.timezone('Europe/Moscow')
 
 def get_unchecked_deals():
     """
-    Возвращает сделки из актуальной таблицы, у которых checked=False.
+    Возвращает сделки из актуальной таблицы, у которых checked=False, за период отслеживания.
     """
+    horizon = datetime.now(TIMEZONE) - timedelta(days=TRACKING_LOOKBACK_DAYS)
     db = next(get_db())  # Создаем сессию базы данных
     try:
-        # Запрос к таблице diff_assigment_id для получения сделок с checked=False
-        results = db.query(DiffAssignmentID.deal_id, DiffAssignmentID.fixed_time).filter(DiffAssignmentID.checked == False).all()
+        # Запрос к таблице diff_assigment_id для получения сделок с checked=False (индекс по checked, fixed_time)
+        results = db.query(DiffAssignmentID.deal_id, DiffAssignmentID.fixed_time).filter(
+            DiffAssignmentID.checked == False,
+            DiffAssignmentID.fixed_time >= horizon
+        ).all()
         return [(result.deal_id, result.fixed_time) for result in results]
     finally:
         db.close()
 
-def get_deal_activities(deal_id, fixed_time):
+def get_deal_activities(unchecked_deals):
     """
-    Получает историю активности сделки с момента зафиксированного времени.
+    Получает завершенные звонки сделок начиная с самого раннего зафиксированного времени.
+    Возвращает CallIndex с звонками, упорядоченными по END_TIME.
     """
-    method = 'crm.activity.list'
-    params = {
-        'filter': {
-            'OWNER_ID': deal_id,
-            'OWNER_TYPE_ID': 2,  # Тип владельца: 2 означает сделку в Bitrix24
-            'TYPE_ID': 2,        # Тип активности: 2 означает звонок
-            'COMPLETED': 'Y',    # Ищем только завершенные активности
-            '>=END_TIME': fixed_time  # Начинаем поиск с зафиксированного времени
-        },
-        'order': {
-            'END_TIME': 'ASC'
-        }
-    }
-
-    response = call_api(method, params=params, http_method='POST')
-    
-    # Проверка и возврат результата
-    if response and 'result' in response:
-        return response['result']
-    return []
+    if not unchecked_deals:
+        return None
+    since = min(fixed_time for _, fixed_time in unchecked_deals)
+    return fetch_call_index([deal_id for deal_id, _ in unchecked_deals], 'END_TIME', completed=True, since=since)
 
+@register('check_uncontacted_clients')
 def check_uncontacted_clients():
     """
     Проверка незаконтакченных клиентов по сделкам, с записью ссылки и ответственного в CRM таблицу.
@@ -53,6 +45,7 @@ def check_uncontacted_clients():
     unchecked_deals = get_unchecked_deals()
     deals_to_notify = []
     rows_to_add = []  # Для записи данных в Google Sheets
+    responsible_ids = []  # ID ответственных по строкам
     current_time = datetime.now(TIMEZONE)
     
     deal_ids = []
@@ -66,9 +59,12 @@ def check_uncontacted_clients():
         deals_data_list = get_deal_data(deal_ids)
         deals_data = {deal['ID']: deal for deal in deals_data_list}
 
+    # Получаем историю звонков всех сделок
+    call_index = get_deal_activities(unchecked_deals)
+
     for deal_id, fixed_time in unchecked_deals:
-        # Исправляем форматирование даты и времени для учета микросекунд
-        fixed_time_dt = datetime.strptime(fixed_time, '%Y-%m-%dT%H:%M:%S.%f%z')
+        # Время фиксации в часовом поясе Москвы (часы сравниваются с рабочим временем)
+        fixed_time_dt = fixed_time.astimezone(TIMEZONE)
 
         # Проверка, передан ли клиент после 18:00
         if fixed_time_dt.hour >= 18:
@@ -77,19 +73,13 @@ def check_uncontacted_clients():
         else:
             time_limit = fixed_time_dt + timedelta(hours=1)
 
-        # Получаем историю активности сделки
-        activities = get_deal_activities(deal_id, fixed_time)
-
-        call_found_within_limit = False
-
-        for activity in activities:
-            end_time_str = activity.get('END_TIME')
-            end_time = datetime.strptime(end_time_str, '%Y-%m-%dT%H:%M:%S%z')
+        if call_index.has_error(deal_id):
+            print(f"Ошибка при получении звонков сделки ID {deal_id}.")
+            continue
 
-            # Проверяем, был ли звонок в течение заданного периода
-            if fixed_time_dt < end_time <= time_limit:
-                call_found_within_limit = True
-                break
+        # Первый звонок, завершенный после времени фиксации; проверяем, уложился ли он в заданный период
+        first_call = call_index.first_after(deal_id, fixed_time_dt, strict=True)
+        call_found_within_limit = first_call is not None and first_call[0] <= time_limit
 
         # Если звонок не был найден в течение заданного периода
         if not call_found_within_limit:
@@ -101,7 +91,7 @@ def check_uncontacted_clients():
                 'deal_id': deal_id,
                 'responsible_id': responsible_id,
                 'created_by_id': created_by_id,
-                'fixed_time': fixed_time,
+                'fixed_time': fixed_time_dt.isoformat(),
                 'call_status': f"Не найден звонок в течение заданного периода ({'до 09:00' if fixed_time_dt.hour >= 18 else 'в течение часа'})"
             })
 
@@ -149,10 +139,11 @@ def check_uncontacted_clients():
                 remark
             ]
             rows_to_add.append(row)
+            responsible_ids.append(item['responsible_id'])
 
     else:
         print("Нет сделок, требующих внимания.")
 
     # Если есть строки для добавления в Google Sheets
     if rows_to_add:
-        write_to_sheet(rows_to_add)
+        report_findings(rows_to_add, responsible_ids)
@@ -0,0 +1,98 @@
+import queue
+import threading
+import time
+import traceback
+from collections import namedtuple
+from contextvars import copy_context
+
+from metrics import check_scope, observe_check
+
+# Результат выполнения одной проверки: status - ok, error или timeout
+CheckResult = namedtuple('CheckResult', ['name', 'status', 'duration', 'error', 'result'])
+
+# Как часто проверять таймауты выполняющихся проверок, в секундах
+POLL_INTERVAL = 1.0
+
+
+def execute_checks(checks, max_workers, timeout):
+    """
+    Выполняет независимые проверки параллельно, не более max_workers одновременно.
+    checks - список пар (имя, функция). Каждая проверка получает собственный таймаут
+    (отсчитывается с момента ее фактического старта), статус и перехват ошибок:
+    исключение или зависание одной проверки не останавливает остальные.
+    Все проверки используют общий лимит запросов клиента Bitrix24.
+    Возвращает список CheckResult в порядке объявления проверок.
+
+    Каждая проверка выполняется в отдельном потоке-демоне. Поток нельзя прервать
+    принудительно, поэтому проверка, превысившая таймаут, завершается в фоне, но ее место
+    сразу освобождается для следующей проверки, а зависший поток не задерживает выход.
+    """
+    finished = queue.Queue()  # (имя, статус, результат или traceback)
+
+    def run(name, func):
+        # Вызовы API, запись в таблицу и найденные нарушения учитываются с меткой проверки
+        with check_scope(name):
+            try:
+                finished.put((name, 'ok', func()))
+            except Exception as e:
+                print(f"Ошибка при выполнении проверки {name}: {e}")
+                finished.put((name, 'error', traceback.format_exc()))
+
+    waiting = list(checks)
+    running = {}  # имя -> время старта
+    results = {}
+
+    while waiting or running:
+        # Запускаем проверки, пока есть свободные места
+        while waiting and len(running) < max_workers:
+            name, func = waiting.pop(0)
+            running[name] = time.monotonic()
+            # Каждая проверка видит кэш запросов и накопитель строк текущего запуска
+            thread = threading.Thread(
+                target=copy_context().run, args=(run, name, func), name=f'check-{name}', daemon=True
+            )
+            thread.start()
+
+        try:
+            items = [finished.get(timeout=POLL_INTERVAL)]
+        except queue.Empty:
+            items = []
+        while True:
+            try:
+                items.append(finished.get_nowait())
+            except queue.Empty:
+                break
+
+        now = time.monotonic()
+        for name, status, value in items:
+            # Проверка, уже снятая по таймауту, завершилась в фоне: результат не учитывается
+            start = running.pop(name, None)
+            if start is None:
+                continue
+            if status == 'ok':
+                results[name] = CheckResult(name, 'ok', now - start, None, value)
+            else:
+                results[name] = CheckResult(name, 'error', now - start, value, None)
+
+        for name, start in list(running.items()):
+            if now - start > timeout:
+                print(f"Проверка {name} не уложилась в {timeout} с и пропущена.")
+                results[name] = CheckResult(name, 'timeout', now - start, f"Превышен таймаут {timeout} с", None)
+                del running[name]
+
+    for result in results.values():
+        observe_check(result)
+
+    return [results[name] for name, _ in checks]
+
+
+def print_summary(results):
+    """
+    Выводит итоги запуска проверок.
+    """
+    print("\nИтоги проверок:")
+    for result in results:
+        line = f"{result.name}: {result.status}, {result.duration:.1f} с"
+        if result.status != 'ok':
+            line += f" ({result.error.strip().splitlines()[-1]})"
+        print(line)
@@ -0,0 +1,111 @@
+from collections import namedtuple
+from functools import partial
+
+# Проверка в реестре: имя, функция и объявленные входные данные
+Check = namedtuple('Check', ['name', 'func', 'needs'])
+
+# Входные данные проверки: вид сущности и функция, возвращающая фильтр на момент запуска
+# (окна по времени отсчитываются от текущего времени, поэтому фильтр строится при планировании).
+# Для зависимых видов (DEPENDENT_KINDS) функция получает уже подготовленные входные данные
+# проверки и возвращает список ID сделок
+Need = namedtuple('Need', ['kind', 'filter'])
+
+# Виды данных: activity - дела из bitrix_activity, deal - сделки из зеркала bitrix_deal,
+# stage_history - история стадий сделок из Bitrix24 (зависит от других входных данных)
+KINDS = ('activity', 'deal', 'stage_history')
+DEPENDENT_KINDS = ('stage_history',)
+
+# Реестр проверок в порядке регистрации
+_registry = []
+
+
+def register(name, needs=None):
+    """
+    Декоратор регистрации проверки. needs - словарь {имя аргумента: Need},
+    данные по нему планировщик загружает заранее и передает проверке именованными аргументами.
+    """
+    def decorator(func):
+        _registry.append(Check(name, func, needs or {}))
+        return func
+    return decorator
+
+
+def registered_checks():
+    """
+    Список зарегистрированных проверок.
+    """
+    return list(_registry)
+
+
+def _stale_input(kind):
+    """
+    Заменяет проверку, источник данных которой не удалось обновить перед запуском.
+    """
+    raise RuntimeError(f"Данные вида {kind} не обновлены перед запуском, проверка не выполнялась")
+
+
+def plan_checks(checks, prefetches, stale=()):
+    """
+    Объединяет объявленные проверками выборки в минимальный набор запросов, выполняет их
+    один раз и возвращает список пар (имя, функция) с подставленными входными данными.
+    prefetches - словарь вид данных -> предварительная выборка запуска (declare/fetch/view).
+    Сначала выполняются независимые выборки, затем зависимые от их результатов.
+
+    Ошибка подготовки фильтра или выборки одного вида данных не прерывает планирование:
+    затронутые проверки получают None и загружают данные сами (или завершаются ошибкой
+    по отдельности в execute_checks).
+
+    stale - виды данных, источник которых не удалось обновить перед запуском (например,
+    синхронизация дел). Проверки, объявившие такие данные, не планируются и завершаются
+    ошибкой, а не работают с устаревшей таблицей.
+    """
+    for check in checks:
+        for need in check.needs.values():
+            if need.kind not in KINDS:
+                raise ValueError(f"Проверка {check.name}: неизвестный вид данных {need.kind}")
+
+    blocked = {}
+    for check in checks:
+        stale_kinds = [need.kind for need in check.needs.values() if need.kind in stale]
+        if stale_kinds:
+            blocked[check.name] = stale_kinds[0]
+    planned_checks = [check for check in checks if check.name not in blocked]
+
+    inputs = {check.name: {} for check in planned_checks}
+    for dependent in (False, True):
+        stage = [
+            (check, arg, need)
+            for check in planned_checks
+            for arg, need in check.needs.items()
+            if (need.kind in DEPENDENT_KINDS) == dependent
+        ]
+        declared = []
+        for check, arg, need in stage:
+            try:
+                declared_filter = need.filter(inputs[check.name]) if dependent else need.filter()
+            except Exception as e:
+                print(f"Проверка {check.name}: не удалось подготовить входные данные {arg}: {e}")
+                inputs[check.name][arg] = None
+                continue
+            prefetches[need.kind].declare(f"{check.name}.{arg}", declared_filter)
+            declared.append((check, arg, need))
+
+        failed_kinds = set()
+        for kind in {need.kind for _, _, need in declared}:
+            try:
+                prefetches[kind].fetch()
+            except Exception as e:
+                print(f"Ошибка при предварительной выборке данных вида {kind}: {e}")
+                failed_kinds.add(kind)
+
+        for check, arg, need in declared:
+            if need.kind in failed_kinds:
+                inputs[check.name][arg] = None
+            else:
+                inputs[check.name][arg] = prefetches[need.kind].view(f"{check.name}.{arg}")
+
+    return [
+        (check.name, partial(_stale_input, blocked[check.name]) if check.name in blocked
+         else partial(check.func, **inputs[check.name]))
+        for check in checks
+    ]
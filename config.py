@@ -8,10 +8,78 @@ load_dotenv()
 WEBHOOK_URL = os.getenv('BITRIX24_WEBHOOK_URL')
 APPLICATION_TOKEN = os.getenv('APPLICATION_TOKEN')
 
+# Пул соединений с Bitrix24
+BITRIX24_POOL_SIZE = int(os.getenv('BITRIX24_POOL_SIZE', '10'))
+BITRIX24_CONNECT_TIMEOUT = float(os.getenv('BITRIX24_CONNECT_TIMEOUT', '5'))
+BITRIX24_READ_TIMEOUT = float(os.getenv('BITRIX24_READ_TIMEOUT', '30'))
+
+# Ограничение частоты запросов к Bitrix24 (портал допускает около 2 запросов в секунду)
+BITRIX24_RATE_LIMIT = float(os.getenv('BITRIX24_RATE_LIMIT', '1.8'))
+BITRIX24_BURST = int(os.getenv('BITRIX24_BURST', '40'))
+BITRIX24_MAX_RETRIES = int(os.getenv('BITRIX24_MAX_RETRIES', '5'))
+BITRIX24_BACKOFF_BASE = float(os.getenv('BITRIX24_BACKOFF_BASE', '1'))
+BITRIX24_BACKOFF_MAX = float(os.getenv('BITRIX24_BACKOFF_MAX', '60'))
+BITRIX24_OPERATING_THRESHOLD = float(os.getenv('BITRIX24_OPERATING_THRESHOLD', '400'))
+
+# Количество страниц списочного метода, запрашиваемых параллельно
+BITRIX24_LIST_WORKERS = int(os.getenv('BITRIX24_LIST_WORKERS', '4'))
+
+# Справочник пользователей: через сколько часов запись считается устаревшей
+USER_DIRECTORY_TTL_HOURS = float(os.getenv('USER_DIRECTORY_TTL_HOURS', '24'))
+
+# Интервал сверки локального зеркала сделок с Bitrix24, в минутах
+DEAL_MIRROR_SYNC_MINUTES = int(os.getenv('DEAL_MIRROR_SYNC_MINUTES', '30'))
+
+# Синхронизация дел: интервал в минутах и глубина первичной загрузки в днях
+ACTIVITY_SYNC_MINUTES = int(os.getenv('ACTIVITY_SYNC_MINUTES', '15'))
+ACTIVITY_SYNC_BACKFILL_DAYS = int(os.getenv('ACTIVITY_SYNC_BACKFILL_DAYS', '30'))
+
+# Запас водяного знака синхронизаций в минутах: следующая выборка начинается с момента
+# старта предыдущей минус запас (расхождение часов портала и сервера, записи в процессе изменения)
+SYNC_SAFETY_MARGIN_MINUTES = int(os.getenv('SYNC_SAFETY_MARGIN_MINUTES', '10'))
+
+# Глубина проверок по таблицам отслеживания сделок (diff_assigment_id, all_created_deal), в днях
+TRACKING_LOOKBACK_DAYS = int(os.getenv('TRACKING_LOOKBACK_DAYS', '14'))
+
+# Сколько дней проверки по сделкам (дополнительный номер, пропущенные звонки) наблюдают
+# за сделкой без окончательного результата, прежде чем перевести ее в expired
+CHECK_STATE_EXPIRY_DAYS = int(os.getenv('CHECK_STATE_EXPIRY_DAYS', '7'))
+
+# Параллельное выполнение проверок: размер пула и таймаут одной проверки в секундах
+CHECK_WORKERS = int(os.getenv('CHECK_WORKERS', '4'))
+CHECK_TIMEOUT_SECONDS = float(os.getenv('CHECK_TIMEOUT_SECONDS', '900'))
+
 SHEET_NAME = os.getenv('SHEET_NAME')
 WORKSHEET_NAME = os.getenv('WORKSHEET_NAME')
 CREDENTIALS_FILE = os.getenv('CREDENTIALS_FILE')
 
+# Запись в Google Sheets: строк в одном append_rows и повторы при превышении квоты записи
+SHEET_APPEND_CHUNK_SIZE = int(os.getenv('SHEET_APPEND_CHUNK_SIZE', '500'))
+SHEET_MAX_RETRIES = int(os.getenv('SHEET_MAX_RETRIES', '5'))
+SHEET_BACKOFF_BASE = float(os.getenv('SHEET_BACKOFF_BASE', '2'))
+SHEET_BACKOFF_MAX = float(os.getenv('SHEET_BACKOFF_MAX', '64'))
+
+# Разделы таблицы: формат периода в имени листа (пусто - без разделов), срок хранения в днях
+# и каталог для архивов старых разделов
+SHEET_PARTITION_FORMAT = os.getenv('SHEET_PARTITION_FORMAT', '%Y-%m')
+SHEET_RETENTION_DAYS = int(os.getenv('SHEET_RETENTION_DAYS', '180'))
+SHEET_ARCHIVE_DIR = os.getenv('SHEET_ARCHIVE_DIR', 'archive')
+
+# Проекции нарушений помимо таблицы finding в базе (через запятую: sheets, file)
+# и путь к файлу для file (.csv - CSV, иначе JSON Lines)
+FINDINGS_SINKS = os.getenv('FINDINGS_SINKS', 'sheets')
+FINDINGS_FILE = os.getenv('FINDINGS_FILE', 'findings.jsonl')
+
+# Очередь событий вебхука: обработчики, опрос пустой очереди, повторы и хранение обработанных событий
+WEBHOOK_WORKERS = int(os.getenv('WEBHOOK_WORKERS', '4'))
+WEBHOOK_POLL_SECONDS = float(os.getenv('WEBHOOK_POLL_SECONDS', '1'))
+WEBHOOK_MAX_ATTEMPTS = int(os.getenv('WEBHOOK_MAX_ATTEMPTS', '5'))
+WEBHOOK_RETRY_BASE_SECONDS = float(os.getenv('WEBHOOK_RETRY_BASE_SECONDS', '30'))
+WEBHOOK_EVENT_RETENTION_DAYS = int(os.getenv('WEBHOOK_EVENT_RETENTION_DAYS', '7'))
+
+# Окно, в течение которого события ONCRMDEALUPDATE по одной сделке объединяются, в секундах
+WEBHOOK_DEBOUNCE_SECONDS = float(os.getenv('WEBHOOK_DEBOUNCE_SECONDS', '10'))
+
 SCHEDULE_HOURS = os.getenv('SCHEDULE_HOURS', '8,10,12,14,16,18')
 SCHEDULE_MINUTE = int(os.getenv('SCHEDULE_MINUTE', '0'))
 SCHEDULE_DAYS = os.getenv('SCHEDULE_DAYS', 'mon-fri') 
@@ -1,7 +1,9 @@
+import time
 import config
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, inspect, text, String
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from metrics import DB_TRANSACTION_DURATION
 
 DATABASE = config.DATABASE
 
@@ -17,6 +19,16 @@ Base = declarative_base()
 # Создаем сессию для работы с базой данных
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# Учет времени транзакций сессий: от первого обращения к базе до commit/rollback
+@event.listens_for(SessionLocal, 'after_begin')
+def _transaction_started(session, transaction, connection):
+    session.info.setdefault('transaction_started', time.monotonic())
+
+@event.listens_for(SessionLocal, 'after_transaction_end')
+def _transaction_ended(session, transaction):
+    if transaction.parent is None and 'transaction_started' in session.info:
+        DB_TRANSACTION_DURATION.observe(time.monotonic() - session.info.pop('transaction_started'))
+
 # Функция для получения сессии (ее будем импортировать в других модулях)
 def get_db():
     db = SessionLocal()
@@ -28,3 +40,36 @@ def get_db():
 # Вызов функции для создания всех таблиц в базе данных, если еще не созданы
 def create_tables():
     Base.metadata.create_all(bind=engine)
+
+# Колонки, которые раньше хранились строками ISO 8601 и переведены в timestamptz
+TIMESTAMP_COLUMNS = [
+    ('diff_assigment_id', 'fixed_time'),
+    ('all_created_deal', 'created_time'),
+]
+
+# Колонки, добавленные в уже существующие таблицы
+ADDED_COLUMNS = [
+    ('webhook_event', 'deal_id', 'integer'),
+]
+
+# Приведение существующей базы к текущим моделям (create_all не меняет существующие таблицы).
+# Повторный запуск ничего не делает
+def migrate_schema():
+    inspector = inspect(engine)
+    with engine.begin() as connection:
+        for table, column in TIMESTAMP_COLUMNS:
+            columns = {item['name']: item for item in inspector.get_columns(table)}
+            if isinstance(columns[column]['type'], String):
+                connection.execute(text(
+                    f"ALTER TABLE {table} ALTER COLUMN {column} TYPE timestamptz "
+                    f"USING NULLIF({column}, '')::timestamptz"
+                ))
+                print(f"Колонка {table}.{column} переведена в timestamptz.")
+
+        for table, column, column_type in ADDED_COLUMNS:
+            connection.execute(text(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {column} {column_type}"))
+
+        # Индексы, объявленные в моделях после создания таблиц
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(connection, checkfirst=True)
@@ -1,10 +1,13 @@
 import pytz
 from apscheduler.schedulers.blocking import BlockingScheduler
 from apscheduler.triggers.cron import CronTrigger
+from apscheduler.triggers.interval import IntervalTrigger
 from datetime import datetime
 from threading import Thread
 
-from database import create_tables  # Импортируем create_tables из database.py
+from database import create_tables, migrate_schema  # Импортируем create_tables из database.py
+from bitrix24_api import run_cache
+from utils import user_directory, sync_deal_mirror, sync_activities, ActivityPrefetch, DealPrefetch, StageHistoryPrefetch, run_sheet_writer, archive_old_partitions, purge_processed_events
 from checks import *  # Импортируем все проверки
 import config  # Импортируем настройки после остальных импортов
 
@@ -16,18 +19,31 @@ def run_checks():
     current_time = datetime.now(timezone).strftime('%Y-%m-%d %H:%M:%S')
     print(f"\nЗапуск проверок в {current_time}\n")
 
-    try:
-        # Выполнение всех проверок поочередно
-        check_overdue_activities()
-        check_next_step_missing()
-        check_deal_not_moved()
-        check_contact_name_missing()
-        check_uncontacted_clients()
-        check_contact_removal()
-        check_additional_phone_number()
-        check_missed_calls()
-    except Exception as e:
-        raise Exception(f"Произошла ошибка во время выполнения проверок: {str(e)}")
+    # Догружаем дела и сделки, измененные с прошлой синхронизации (зеркало сделок могло отстать
+    # на интервал сверки или на очередь вебхука). Если синхронизация не удалась, проверки
+    # по соответствующей таблице завершаются ошибкой, а не работают с устаревшими данными
+    stale = set()
+    for kind, sync in (('activity', sync_activities), ('deal', sync_deal_mirror)):
+        try:
+            sync()
+        except Exception:
+            stale.add(kind)
+
+    # Кэш запросов общий для всех проверок запуска и очищается по его завершении,
+    # строки всех проверок записываются в таблицу одним запросом при выходе из блока
+    with run_cache(), run_sheet_writer():
+        # Планировщик объединяет объявленные проверками выборки и загружает их один раз
+        checks = plan_checks(registered_checks(), {
+            'activity': ActivityPrefetch(),
+            'deal': DealPrefetch(),
+            'stage_history': StageHistoryPrefetch(),
+        }, stale)
+
+        # Проверки независимы и выполняются параллельно; ошибка одной не отменяет остальные
+        results = execute_checks(checks, config.CHECK_WORKERS, config.CHECK_TIMEOUT_SECONDS)
+
+    print_summary(results)
+    return results
 
 def start_scheduler():
     """
@@ -46,6 +62,21 @@ def start_scheduler():
     # Добавляем задачу в планировщик
     scheduler.add_job(run_checks, trigger)
 
+    # Досылаем в зеркало сделок изменения, пропущенные вебхуком
+    scheduler.add_job(sync_deal_mirror, IntervalTrigger(minutes=config.DEAL_MIRROR_SYNC_MINUTES))
+
+    # Инкрементальная синхронизация дел между запусками проверок
+    scheduler.add_job(sync_activities, IntervalTrigger(minutes=config.ACTIVITY_SYNC_MINUTES))
+
+    # Обновляем устаревшие записи справочника пользователей
+    scheduler.add_job(user_directory.refresh_stale, IntervalTrigger(hours=config.USER_DIRECTORY_TTL_HOURS))
+
+    # Ночью переносим в архив разделы таблицы старше срока хранения
+    scheduler.add_job(archive_old_partitions, CronTrigger(hour=3, minute=0))
+
+    # Удаляем из очереди давно обработанные события вебхука
+    scheduler.add_job(purge_processed_events, CronTrigger(hour=3, minute=30))
+
     print("Планировщик проверок запущен.")
     print("Проверки будут выполняться в указанные часы с 8:00 до 18:00 МСК в будние дни.")
 
@@ -66,9 +97,16 @@ def main():
     """
     Главная функция, которая запускает сервер и планировщик проверок.
     """
-    # Выполняем тестовые проверки
+    # Загружаем справочник пользователей в память
+    user_directory.load()
+
+    # Выполняем тестовые проверки (перед ними сверяется зеркало сделок, при первом запуске - полная загрузка)
     run_checks()
     
+    # Запускаем обработчики очереди событий вебхука
+    from webhooks.worker import start_workers
+    start_workers()
+
     # Создаем отдельный поток для запуска Flask-приложения
     flask_thread = Thread(target=start_flask_app)
     flask_thread.daemon = True
@@ -80,4 +118,6 @@ def main():
 if __name__ == "__main__":
     # Создаем таблицы, если они еще не созданы
     create_tables()
+    # Приводим существующие таблицы к текущим моделям
+    migrate_schema()
     main()
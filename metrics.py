@@ -0,0 +1,107 @@
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from prometheus_client import Counter, Histogram, generate_latest, CONTENT_TYPE_LATEST
+
+# Метрики в формате Prometheus, отдаются Flask-приложением на /metrics.
+# Метка check показывает, какая проверка сделала вызов: по ней видно, кто расходует лимит портала.
+
+API_CALLS = Counter(
+    'bitrix24_api_calls_total', 'HTTP-запросы к Bitrix24', ['method', 'check', 'status']
+)
+API_RETRIES = Counter(
+    'bitrix24_api_retries_total', 'Повторы запросов к Bitrix24', ['method', 'check', 'reason']
+)
+API_BYTES = Counter(
+    'bitrix24_api_response_bytes_total', 'Объем ответов Bitrix24 в байтах', ['method', 'check']
+)
+API_LATENCY = Histogram(
+    'bitrix24_api_latency_seconds', 'Время ответа Bitrix24', ['method'],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+)
+API_BATCH_COMMANDS = Counter(
+    'bitrix24_batch_commands_total', 'Команды внутри batch-запросов', ['method', 'check']
+)
+API_CACHE_HITS = Counter(
+    'bitrix24_cache_hits_total', 'Ответы, взятые из кэша запуска', ['method', 'check']
+)
+
+SHEET_WRITE_LATENCY = Histogram(
+    'sheet_write_seconds', 'Длительность записи в Google Sheets'
+)
+SHEET_ROWS_WRITTEN = Counter(
+    'sheet_rows_written_total', 'Строки, добавленные в Google Sheets', ['check']
+)
+
+DB_TRANSACTION_DURATION = Histogram(
+    'db_transaction_seconds', 'Длительность транзакций сессий базы данных',
+    buckets=(0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 30, 120)
+)
+
+WEBHOOK_EVENTS = Counter(
+    'webhook_events_total', 'Обработанные события вебхука', ['event', 'status']
+)
+WEBHOOK_EVENTS_COALESCED = Counter(
+    'webhook_events_coalesced_total', 'События, объединенные с более ранним событием по той же сделке', ['event']
+)
+
+CHECK_DURATION = Histogram(
+    'check_duration_seconds', 'Длительность проверки', ['check'],
+    buckets=(1, 5, 15, 30, 60, 120, 300, 600, 900)
+)
+CHECK_RUNS = Counter(
+    'check_runs_total', 'Запуски проверок по итоговому статусу', ['check', 'status']
+)
+CHECK_ROWS_FLAGGED = Counter(
+    'check_rows_flagged_total', 'Нарушения, найденные проверкой', ['check']
+)
+
+# Проверка, в рамках которой выполняется текущий код (вне проверок - none)
+_current_check = ContextVar('current_check', default='none')
+
+
+def current_check():
+    """
+    Имя выполняющейся проверки для метки check.
+    """
+    return _current_check.get()
+
+
+@contextmanager
+def check_scope(name):
+    """
+    Помечает вызовы внутри блока with именем проверки.
+    """
+    token = _current_check.set(name)
+    try:
+        yield
+    finally:
+        _current_check.reset(token)
+
+
+@contextmanager
+def timed(histogram):
+    """
+    Измеряет длительность блока with.
+    """
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        histogram.observe(time.monotonic() - start)
+
+
+def observe_check(result):
+    """
+    Учитывает результат проверки (CheckResult из checks.executor).
+    """
+    CHECK_DURATION.labels(result.name).observe(result.duration)
+    CHECK_RUNS.labels(result.name, result.status).inc()
+
+
+def render_metrics():
+    """
+    Текущие значения метрик в текстовом формате Prometheus: (тело, Content-Type).
+    """
+    return generate_latest(), CONTENT_TYPE_LATEST
@@ -1,4 +1,14 @@
-from .models import DiffAssignmentID, AllCreatedDeal, DelDealsContact
+from .models import DiffAssignmentID, AllCreatedDeal, DelDealsContact, BitrixUser, BitrixDeal, BitrixActivity, SyncState, SheetRowHash, Finding, WebhookEvent, DealCheckState
 from .deal_utils import get_deal_data
+from .contact_utils import get_contact_data, cache_contacts
+from .deal_mirror import sync_deal_mirror, upsert_deals, delete_deal, deal_upsert_statement, DEAL_FIELDS
 from .user_utils import get_user_names
-from .google_sheets import write_to_sheet
\ No newline at end of file
+from .user_store import user_directory
+from .google_sheets import write_to_sheet, rebuild_sheet_dedup_index, run_sheet_writer, archive_old_partitions
+from .activity_store import sync_activities, query_activities, delete_activity
+from .prefetch import ActivityPrefetch, DealPrefetch, StageHistoryPrefetch
+from .activity_index import fetch_call_index, CallIndex
+from .frames import to_frame, parse_times, to_timestamp, local_hours, local_strings
+from .findings import report_findings
+from .event_queue import enqueue_event, purge_processed_events
+from .check_state import pending_deals, save_check_states, PENDING, SATISFIED, FLAGGED, EXPIRED
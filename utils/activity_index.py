@@ -0,0 +1,136 @@
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+
+from bitrix24_api import BatchRequest, Bitrix24Error, iter_list, extract_records, PAGE_SIZE
+from .field_mapping import TIMEZONE, parse_datetime
+
+ACTIVITIES_METHOD = 'crm.activity.list'
+
+# Количество сделок в одном фильтре OWNER_ID (ограничение размера фильтра на портале)
+OWNER_CHUNK_SIZE = 50
+
+# Поля звонка, которые нужны проверкам
+CALL_SELECT = ['ID', 'OWNER_ID', 'START_TIME', 'END_TIME', 'COMPLETED']
+
+
+class CallIndex:
+    """
+    Звонки по сделкам в памяти: для каждой сделки список, отсортированный по полю time_field,
+    и поиск первого звонка после заданного момента двоичным поиском.
+    """
+
+    def __init__(self, calls, time_field, failed=()):
+        self.time_field = time_field
+        # Сделки, звонки по которым получить не удалось
+        self.failed = {int(deal_id) for deal_id in failed}
+        self._times = {}
+        self._calls = {}
+
+        by_deal = defaultdict(list)
+        for call in calls:
+            value = call.get(time_field)
+            if value:
+                by_deal[int(call['OWNER_ID'])].append((parse_datetime(value), call))
+
+        for deal_id, items in by_deal.items():
+            items.sort(key=lambda item: item[0])
+            self._times[deal_id] = [moment for moment, _ in items]
+            self._calls[deal_id] = [call for _, call in items]
+
+    def has_error(self, deal_id):
+        return int(deal_id) in self.failed
+
+    def all_calls(self):
+        """
+        Все звонки индекса.
+        """
+        return [call for calls in self._calls.values() for call in calls]
+
+    def calls(self, deal_id):
+        """
+        Все звонки сделки в порядке времени.
+        """
+        return self._calls.get(int(deal_id), [])
+
+    def calls_after(self, deal_id, moment, strict=False):
+        """
+        Звонки сделки со временем не раньше moment (strict=True - строго позже).
+        """
+        deal_id = int(deal_id)
+        times = self._times.get(deal_id, [])
+        position = (bisect_right if strict else bisect_left)(times, moment)
+        return self._calls.get(deal_id, [])[position:]
+
+    def first_after(self, deal_id, moment=None, strict=False):
+        """
+        Первый звонок сделки не раньше moment (или самый первый, если moment не задан):
+        пара (время, звонок) или None.
+        """
+        deal_id = int(deal_id)
+        times = self._times.get(deal_id, [])
+        position = 0 if moment is None else (bisect_right if strict else bisect_left)(times, moment)
+        if position >= len(times):
+            return None
+        return times[position], self._calls[deal_id][position]
+
+
+def _chunk_params(chunk, base_filter):
+    return {
+        'filter': dict(base_filter, OWNER_ID=chunk),
+        'order': {'ID': 'ASC'},
+        'select': CALL_SELECT,
+        'start': -1,
+    }
+
+
+def fetch_call_index(deal_ids, time_field, completed=None, since=None):
+    """
+    Загружает звонки по набору сделок и строит CallIndex по полю time_field (START_TIME или END_TIME).
+    Сделки объединяются в фильтры OWNER_ID по OWNER_CHUNK_SIZE, первые страницы всех частей
+    запрашиваются через batch, а части, не уместившиеся в страницу, догружаются курсором по ID.
+    completed - только завершенные (True) или незавершенные (False) звонки, since - нижняя граница time_field.
+    """
+    ids = sorted({int(deal_id) for deal_id in deal_ids})
+
+    base_filter = {
+        'OWNER_TYPE_ID': 2,  # Сделка
+        'TYPE_ID': 2,        # Звонок
+    }
+    if completed is not None:
+        base_filter['COMPLETED'] = 'Y' if completed else 'N'
+    if since is not None:
+        base_filter[f'>={time_field}'] = since.astimezone(TIMEZONE).strftime('%Y-%m-%dT%H:%M:%S%z')
+
+    chunks = [ids[i:i + OWNER_CHUNK_SIZE] for i in range(0, len(ids), OWNER_CHUNK_SIZE)]
+
+    batch = BatchRequest()
+    for number, chunk in enumerate(chunks):
+        batch.add(number, ACTIVITIES_METHOD, _chunk_params(chunk, base_filter))
+    results, errors = batch.execute()
+
+    calls = []
+    failed = []
+    for number, chunk in enumerate(chunks):
+        if str(number) in errors:
+            print(f"Ошибка при получении звонков по сделкам {chunk[0]}..{chunk[-1]}: {errors[str(number)]}")
+            failed.extend(chunk)
+            continue
+
+        records = list(extract_records(results.get(str(number)) or []))
+
+        # Полная страница: остальные звонки части загружаются курсором по ID.
+        # Если догрузка прервалась, звонки части неполные, и ее сделки считаются неполученными
+        if len(records) >= PAGE_SIZE:
+            params = _chunk_params(chunk, base_filter)
+            params['filter']['>ID'] = records[-1]['ID']
+            try:
+                records.extend(iter_list(ACTIVITIES_METHOD, params, fast=True))
+            except Bitrix24Error as e:
+                print(f"Ошибка при догрузке звонков по сделкам {chunk[0]}..{chunk[-1]}: {e}")
+                failed.extend(chunk)
+                continue
+
+        calls.extend(records)
+
+    print(f"Звонков загружено: {len(calls)} по {len(ids)} сделкам ({len(chunks)} частей).")
+    return CallIndex(calls, time_field, failed)
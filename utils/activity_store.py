@@ -0,0 +1,145 @@
+import threading
+from datetime import datetime, timedelta
+
+from sqlalchemy.dialects.postgresql import insert
+
+from bitrix24_api import iter_list, fetch_list_concurrent
+from config import ACTIVITY_SYNC_BACKFILL_DAYS, SYNC_SAFETY_MARGIN_MINUTES
+from database import get_db
+from .models import BitrixActivity, SyncState
+from .field_mapping import TIMEZONE, record_to_row, row_to_record, apply_api_filter
+
+ACTIVITIES_METHOD = 'crm.activity.list'
+
+# Имя записи водяного знака в таблице sync_state
+SYNC_STATE_NAME = 'crm.activity'
+
+# Поля дела, которые хранятся в локальной таблице: поле Bitrix24 -> (колонка, тип)
+ACTIVITY_FIELDS = {
+    'ID': ('activity_id', int),
+    'OWNER_ID': ('owner_id', int),
+    'OWNER_TYPE_ID': ('owner_type_id', int),
+    'TYPE_ID': ('type_id', int),
+    'DIRECTION': ('direction', int),
+    'COMPLETED': ('completed', bool),
+    'RESPONSIBLE_ID': ('responsible_id', int),
+    'SUBJECT': ('subject', str),
+    'START_TIME': ('start_time', datetime),
+    'END_TIME': ('end_time', datetime),
+    'DEADLINE': ('deadline', datetime),
+    'CREATED': ('created', datetime),
+    'LAST_UPDATED': ('last_updated', datetime),
+}
+
+# Количество дел в одном INSERT
+UPSERT_CHUNK_SIZE = 500
+
+# Синхронизацию запускают и планировщик, и запуск проверок: одновременно выполняется только одна
+_sync_lock = threading.Lock()
+
+
+def upsert_activities(db, activities):
+    """
+    Добавляет или обновляет дела в локальной таблице. Коммит выполняет вызывающий код.
+    """
+    # Одно дело может прийти дважды (пересечение выборок), а ON CONFLICT не допускает повторов в одной команде
+    rows = list({
+        row['activity_id']: row
+        for row in (record_to_row(activity, ACTIVITY_FIELDS) for activity in activities if activity.get('ID'))
+    }.values())
+    for i in range(0, len(rows), UPSERT_CHUNK_SIZE):
+        statement = insert(BitrixActivity).values(rows[i:i + UPSERT_CHUNK_SIZE])
+        statement = statement.on_conflict_do_update(
+            index_elements=[BitrixActivity.activity_id],
+            set_={column: statement.excluded[column] for column, _ in ACTIVITY_FIELDS.values() if column != 'activity_id'}
+        )
+        db.execute(statement)
+
+
+def delete_activity(db, activity_id):
+    """
+    Удаляет дело из локальной таблицы. Коммит выполняет вызывающий код.
+    """
+    db.query(BitrixActivity).filter(BitrixActivity.activity_id == int(activity_id)).delete()
+
+
+def sync_activities():
+    """
+    Инкрементальная синхронизация дел: загружает только дела с LAST_UPDATED не раньше сохраненного
+    водяного знака и записывает их в bitrix_activity. Новый водяной знак - время начала
+    синхронизации минус SYNC_SAFETY_MARGIN_MINUTES: дела загружаются в порядке ID, а не LAST_UPDATED,
+    поэтому максимальный полученный LAST_UPDATED может обогнать дела, еще не выгруженные
+    или измененные во время синхронизации. Ошибка загрузки любой страницы откатывает транзакцию,
+    и водяной знак не сдвигается.
+
+    При первом запуске загружаются дела, обновленные за ACTIVITY_SYNC_BACKFILL_DAYS дней,
+    и все незавершенные дела независимо от даты (они нужны проверке просроченных дел).
+
+    Ошибка синхронизации выбрасывается дальше: вызывающий код должен знать, что таблица дел устарела.
+    """
+    with _sync_lock:
+        db = next(get_db())
+        try:
+            started_at = datetime.now(TIMEZONE)
+            state = db.get(SyncState, SYNC_STATE_NAME)
+            select = list(ACTIVITY_FIELDS)
+
+            if state and state.watermark:
+                watermark = state.watermark
+                activities = iter_list(ACTIVITIES_METHOD, {
+                    'filter': {'>=LAST_UPDATED': watermark.astimezone(TIMEZONE).strftime('%Y-%m-%dT%H:%M:%S%z')},
+                    'select': select,
+                }, fast=True)
+            else:
+                # Первичная загрузка: страницы запрашиваются параллельно
+                watermark = datetime.now(TIMEZONE) - timedelta(days=ACTIVITY_SYNC_BACKFILL_DAYS)
+                activities = fetch_list_concurrent(ACTIVITIES_METHOD, {
+                    'filter': {'>=LAST_UPDATED': watermark.strftime('%Y-%m-%dT%H:%M:%S%z')},
+                    'select': select,
+                }) + fetch_list_concurrent(ACTIVITIES_METHOD, {
+                    'filter': {'COMPLETED': 'N'},
+                    'select': select,
+                })
+
+            synced = 0
+            chunk = []
+            for activity in activities:
+                chunk.append(activity)
+                if len(chunk) >= UPSERT_CHUNK_SIZE:
+                    upsert_activities(db, chunk)
+                    synced += len(chunk)
+                    chunk = []
+
+            if chunk:
+                upsert_activities(db, chunk)
+                synced += len(chunk)
+
+            # Водяной знак сохраняется в той же транзакции, что и дела, и никогда не сдвигается назад
+            if state is None:
+                state = SyncState(name=SYNC_STATE_NAME)
+                db.add(state)
+            state.watermark = max(watermark, started_at - timedelta(minutes=SYNC_SAFETY_MARGIN_MINUTES))
+            db.commit()
+
+            print(f"Синхронизация дел: обновлено {synced} дел.")
+        except Exception as e:
+            db.rollback()
+            print(f"Ошибка при синхронизации дел: {e}")
+            raise
+        finally:
+            db.close()
+
+
+def query_activities(api_filter, order_by=None):
+    """
+    Возвращает дела из локальной таблицы в формате ответа crm.activity.list.
+    Фильтр задается так же, как для API: {'COMPLETED': 'Y', '>=END_TIME': ..., 'TYPE_ID': 6}.
+    """
+    db = next(get_db())
+    try:
+        query = apply_api_filter(db.query(BitrixActivity), BitrixActivity, ACTIVITY_FIELDS, api_filter)
+        if order_by:
+            query = query.order_by(getattr(BitrixActivity, ACTIVITY_FIELDS[order_by][0]))
+        return [row_to_record(row, ACTIVITY_FIELDS) for row in query.all()]
+    finally:
+        db.close()
@@ -0,0 +1,76 @@
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, or_, select, literal, String, DateTime
+from sqlalchemy.dialects.postgresql import insert
+
+from .models import DealCheckState
+from .field_mapping import TIMEZONE
+
+# Состояния сделки в проверке: pending - результат еще может измениться,
+# satisfied - условие выполнено, flagged - нарушение записано, expired - вышел срок наблюдения
+PENDING = 'pending'
+SATISFIED = 'satisfied'
+FLAGGED = 'flagged'
+EXPIRED = 'expired'
+
+
+def _state_join(model, check_name):
+    return and_(DealCheckState.deal_id == model.deal_id, DealCheckState.check_name == check_name)
+
+
+def _open_state():
+    return or_(DealCheckState.status.is_(None), DealCheckState.status == PENDING)
+
+
+def pending_deals(db, check_name, time_column, expiry):
+    """
+    Возвращает строки (deal_id, время) таблицы отслеживания, по которым проверка check_name
+    еще не получила окончательного результата. Сделки, время которых старше expiry,
+    сначала переводятся в expired, поэтому каждый запуск обрабатывает только открытые сделки.
+    Коммит выполняет вызывающий код.
+    """
+    model = time_column.class_
+    now = datetime.now(TIMEZONE)
+    horizon = now - expiry
+
+    # Открытые сделки за горизонтом: expired (запрос по индексу времени, без обращений к API)
+    stale = (
+        select(
+            model.deal_id,
+            literal(check_name, String),
+            literal(EXPIRED, String),
+            literal(now, DateTime(timezone=True)),
+        )
+        .outerjoin(DealCheckState, _state_join(model, check_name))
+        .where(time_column < horizon, _open_state())
+    )
+    statement = insert(DealCheckState).from_select(['deal_id', 'check_name', 'status', 'updated_at'], stale)
+    db.execute(statement.on_conflict_do_update(
+        index_elements=[DealCheckState.deal_id, DealCheckState.check_name],
+        set_={'status': statement.excluded.status, 'updated_at': statement.excluded.updated_at},
+    ))
+
+    return (
+        db.query(model.deal_id, time_column)
+        .outerjoin(DealCheckState, _state_join(model, check_name))
+        .filter(time_column >= horizon, _open_state())
+        .all()
+    )
+
+
+def save_check_states(db, check_name, states):
+    """
+    Сохраняет результаты проверки по сделкам: states - словарь {deal_id: состояние}.
+    Коммит выполняет вызывающий код.
+    """
+    if not states:
+        return
+    now = datetime.now(TIMEZONE)
+    statement = insert(DealCheckState).values([
+        {'deal_id': int(deal_id), 'check_name': check_name, 'status': status, 'updated_at': now}
+        for deal_id, status in states.items()
+    ])
+    db.execute(statement.on_conflict_do_update(
+        index_elements=[DealCheckState.deal_id, DealCheckState.check_name],
+        set_={'status': statement.excluded.status, 'updated_at': statement.excluded.updated_at},
+    ))
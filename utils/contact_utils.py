@@ -0,0 +1,56 @@
+from bitrix24_api import call_api, get_run_cache
+
+CONTACTS_METHOD = 'crm.contact.list'
+
+# Поля контакта, которые нужны проверкам
+CONTACT_SELECT = ['ID', 'NAME', 'LAST_NAME', 'PHONE', 'ASSIGNED_BY_ID']
+
+
+def cache_contacts(contacts):
+    """
+    Сохраняет контакты, полученные проверкой, в кэш текущего запуска (если он активен).
+    """
+    cache = get_run_cache()
+    if cache is not None:
+        cache.put_entities('contact', {contact['ID']: contact for contact in contacts})
+
+
+def get_contact_data(contact_ids):
+    """
+    Получает данные о контактах по их списку ID: один запрос crm.contact.list с фильтром по ID
+    на каждые 50 контактов вместо crm.contact.get на каждый контакт.
+    """
+    contact_data_list = []
+
+    # Убираем дубликаты из списка ID
+    unique_contact_ids = list({str(contact_id) for contact_id in contact_ids if contact_id})
+
+    # Контакты, уже полученные в текущем запуске проверок, берем из кэша
+    cache = get_run_cache()
+    if cache is not None:
+        cached_contacts, unique_contact_ids = cache.get_entities('contact', unique_contact_ids)
+        contact_data_list.extend(cached_contacts.values())
+
+    batch_size = 50  # Ограничение на количество элементов в одном запросе (ограничения API)
+
+    # Получаем данные о контактах батчами по batch_size ID за один запрос
+    for i in range(0, len(unique_contact_ids), batch_size):
+        batch_ids = unique_contact_ids[i:i + batch_size]
+        params = {
+            'filter': {
+                'ID': batch_ids
+            },
+            'select': CONTACT_SELECT
+        }
+        response = call_api(CONTACTS_METHOD, params=params, http_method='POST')
+
+        # Проверяем наличие результатов в ответе
+        if response and 'result' in response:
+            contacts = [{field: contact.get(field) for field in CONTACT_SELECT} for contact in response['result']]
+            contact_data_list.extend(contacts)
+            cache_contacts(contacts)
+        else:
+            print("Ошибка при получении информации о контактах.")
+            continue
+
+    return contact_data_list
@@ -0,0 +1,160 @@
+import threading
+from datetime import datetime, timedelta
+
+from sqlalchemy.dialects.postgresql import insert
+
+from bitrix24_api import iter_list
+from config import SYNC_SAFETY_MARGIN_MINUTES
+from database import get_db
+from .models import BitrixDeal, SyncState
+from .field_mapping import TIMEZONE, record_to_row, row_to_record
+
+# Поля сделки, которые хранятся в зеркале: поле Bitrix24 -> (колонка, тип)
+DEAL_FIELDS = {
+    'ID': ('deal_id', int),
+    'CONTACT_ID': ('contact_id', int),
+    'COMPANY_ID': ('company_id', int),
+    'ASSIGNED_BY_ID': ('assigned_by_id', int),
+    'CREATED_BY_ID': ('created_by_id', int),
+    'CATEGORY_ID': ('category_id', int),
+    'STAGE_ID': ('stage_id', str),
+    'TITLE': ('title', str),
+    'DATE_CREATE': ('date_create', datetime),
+    'CLOSEDATE': ('closedate', datetime),
+    'DATE_MODIFY': ('date_modify', datetime),
+}
+
+# Количество сделок в одном INSERT при сверке
+UPSERT_CHUNK_SIZE = 500
+
+# Имя записи водяного знака сверки в таблице sync_state
+SYNC_STATE_NAME = 'crm.deal'
+
+# Сверку запускают и планировщик, и запуск проверок: одновременно выполняется только одна
+_sync_lock = threading.Lock()
+
+
+def upsert_deals(db, deals):
+    """
+    Добавляет или обновляет сделки в зеркале. Запись не перезаписывается более старой версией сделки.
+    Коммит выполняет вызывающий код.
+    """
+    # ON CONFLICT не допускает повторов одной сделки в одной команде
+    rows = list({
+        row['deal_id']: row
+        for row in (record_to_row(deal, DEAL_FIELDS) for deal in deals if deal.get('ID'))
+    }.values())
+    for i in range(0, len(rows), UPSERT_CHUNK_SIZE):
+        db.execute(deal_upsert_statement(rows[i:i + UPSERT_CHUNK_SIZE]))
+
+
+def deal_upsert_statement(rows):
+    """
+    INSERT ... ON CONFLICT для строк зеркала (результат record_to_row), без повторов deal_id.
+    Запись не перезаписывается более старой версией сделки.
+    """
+    statement = insert(BitrixDeal).values(rows)
+    return statement.on_conflict_do_update(
+        index_elements=[BitrixDeal.deal_id],
+        set_={column: statement.excluded[column] for column, _ in DEAL_FIELDS.values() if column != 'deal_id'},
+        where=(BitrixDeal.date_modify.is_(None))
+              | (statement.excluded.date_modify.is_(None))
+              | (BitrixDeal.date_modify <= statement.excluded.date_modify)
+    )
+
+
+def delete_deal(db, deal_id):
+    """
+    Удаляет сделку из зеркала. Коммит выполняет вызывающий код.
+    """
+    db.query(BitrixDeal).filter(BitrixDeal.deal_id == int(deal_id)).delete()
+
+
+def save_deals(deals):
+    """
+    Сохраняет сделки в зеркале в отдельной сессии.
+    """
+    if not deals:
+        return
+
+    db = next(get_db())
+    try:
+        upsert_deals(db, deals)
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        print(f"Не удалось сохранить сделки в зеркало: {e}")
+    finally:
+        db.close()
+
+
+def load_deals(deal_ids):
+    """
+    Возвращает сделки из зеркала в формате API: словарь ID (строкой) -> данные сделки.
+    """
+    ids = [int(deal_id) for deal_id in deal_ids if deal_id]
+    if not ids:
+        return {}
+
+    db = next(get_db())
+    try:
+        rows = db.query(BitrixDeal).filter(BitrixDeal.deal_id.in_(ids)).all()
+        return {str(row.deal_id): row_to_record(row, DEAL_FIELDS) for row in rows}
+    except Exception as e:
+        print(f"Не удалось прочитать сделки из зеркала: {e}")
+        return {}
+    finally:
+        db.close()
+
+
+def sync_deal_mirror():
+    """
+    Сверка зеркала с Bitrix24: загружает сделки, измененные после водяного знака сверки.
+    Без водяного знака выполняет полную загрузку. Досылает изменения, пропущенные вебхуком.
+
+    Водяной знак хранится в sync_state отдельно от DATE_MODIFY в зеркале: вебхук пишет
+    DATE_MODIFY в ту же таблицу, и пропущенное им изменение оказалось бы ниже максимума.
+    Он равен времени начала сверки минус SYNC_SAFETY_MARGIN_MINUTES и сохраняется только
+    после успешной загрузки всех страниц. Ошибка сверки выбрасывается дальше:
+    вызывающий код должен знать, что зеркало устарело.
+    """
+    with _sync_lock:
+        db = next(get_db())
+        try:
+            started_at = datetime.now(TIMEZONE)
+            state = db.get(SyncState, SYNC_STATE_NAME)
+            watermark = state.watermark if state else None
+
+            params = {'select': list(DEAL_FIELDS)}
+            if watermark:
+                params['filter'] = {'>=DATE_MODIFY': watermark.astimezone(TIMEZONE).strftime('%Y-%m-%dT%H:%M:%S%z')}
+
+            synced = 0
+            chunk = []
+            for deal in iter_list('crm.deal.list', params, fast=True):
+                chunk.append(deal)
+                if len(chunk) >= UPSERT_CHUNK_SIZE:
+                    upsert_deals(db, chunk)
+                    db.commit()
+                    synced += len(chunk)
+                    chunk = []
+
+            if chunk:
+                upsert_deals(db, chunk)
+                synced += len(chunk)
+
+            # Сверка завершена: сдвигаем водяной знак вместе с последней частью сделок
+            if state is None:
+                state = SyncState(name=SYNC_STATE_NAME)
+                db.add(state)
+            new_watermark = started_at - timedelta(minutes=SYNC_SAFETY_MARGIN_MINUTES)
+            state.watermark = max(watermark, new_watermark) if watermark else new_watermark
+            db.commit()
+
+            print(f"Сверка зеркала сделок: обновлено {synced} сделок.")
+        except Exception as e:
+            db.rollback()
+            print(f"Ошибка при сверке зеркала сделок: {e}")
+            raise
+        finally:
+            db.close()
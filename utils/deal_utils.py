@@ -1,14 +1,31 @@
-from bitrix24_api import call_api
+from bitrix24_api import call_api, get_run_cache
+from .deal_mirror import load_deals, save_deals
 
 def get_deal_data(deal_ids):
     """
     Получает данные о сделках по их списку ID, включая всю необходимую информацию для записи в Google Sheets.
+    Сделки берутся из локального зеркала bitrix_deal, в Bitrix24 запрашиваются только отсутствующие в нем.
     """
     DEALS_METHOD = 'crm.deal.list'
     deal_data_list = []
 
     # Убираем дубликаты из списка ID
     unique_deal_ids = list(set(deal_ids))
+
+    # Сделки, уже полученные в текущем запуске проверок, берем из кэша
+    cache = get_run_cache()
+    if cache is not None:
+        cached_deals, unique_deal_ids = cache.get_entities('deal', unique_deal_ids)
+        deal_data_list.extend(cached_deals.values())
+
+    # Сделки из локального зеркала, которое поддерживает вебхук
+    mirrored_deals = load_deals(unique_deal_ids)
+    deal_data_list.extend(mirrored_deals.values())
+    unique_deal_ids = [deal_id for deal_id in unique_deal_ids if str(deal_id) not in mirrored_deals]
+    if cache is not None:
+        cache.put_entities('deal', mirrored_deals)
+
+    fetched_deals = []
     batch_size = 50  # Ограничение на количество элементов в одном запросе (ограничения API)
 
     # Получаем данные о сделках батчами по batch_size ID за один запрос
@@ -29,6 +46,7 @@ def get_deal_data(deal_ids):
                 'TITLE',  # Название сделки
                 'DATE_CREATE',  # Дата создания
                 'CLOSEDATE',  # Дата закрытия (планируемая)
+                'DATE_MODIFY',  # Дата изменения (для зеркала)
             ]
         }
         response = call_api(DEALS_METHOD, params=params, http_method='POST')
@@ -49,10 +67,18 @@ def get_deal_data(deal_ids):
                     'TITLE': deal.get('TITLE'),
                     'DATE_CREATE': deal.get('DATE_CREATE'),
                     'CLOSEDATE': deal.get('CLOSEDATE'),
+                    'DATE_MODIFY': deal.get('DATE_MODIFY'),
                 }
                 deal_data_list.append(filtered_data)
+                fetched_deals.append(filtered_data)
+
+                if cache is not None:
+                    cache.put_entities('deal', {filtered_data['ID']: filtered_data})
         else:
             print("Ошибка при получении информации о сделках.")
             continue
 
+    # Сохраняем полученные из API сделки в зеркало
+    save_deals(fetched_deals)
+
     return deal_data_list
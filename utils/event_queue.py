@@ -0,0 +1,121 @@
+from datetime import datetime, timedelta
+
+from config import WEBHOOK_MAX_ATTEMPTS, WEBHOOK_RETRY_BASE_SECONDS, WEBHOOK_EVENT_RETENTION_DAYS, WEBHOOK_DEBOUNCE_SECONDS
+from database import get_db
+from .models import WebhookEvent
+from .field_mapping import TIMEZONE
+
+# Статусы события в очереди
+PENDING = 'pending'
+DONE = 'done'
+FAILED = 'failed'
+
+# События, которые объединяются по сделке: обрабатывается одно, применяется актуальное состояние
+COALESCED_EVENTS = ('ONCRMDEALUPDATE',)
+
+
+def event_deal_id(event, payload):
+    """
+    ID сделки из события о сделке или None.
+    """
+    if not event or not event.startswith('ONCRMDEAL'):
+        return None
+    try:
+        return int(payload.get('data[FIELDS][ID]'))
+    except (TypeError, ValueError):
+        return None
+
+
+def enqueue_event(db, event, payload):
+    """
+    Сохраняет событие вебхука в очередь. Коммит выполняет вызывающий код.
+    """
+    now = datetime.now(TIMEZONE)
+    available_at = now
+    if event in COALESCED_EVENTS:
+        # Обработка откладывается на окно, за которое приходят остальные события той же правки
+        available_at = now + timedelta(seconds=WEBHOOK_DEBOUNCE_SECONDS)
+
+    db.add(WebhookEvent(
+        event=event,
+        deal_id=event_deal_id(event, payload),
+        payload=payload,
+        status=PENDING,
+        attempts=0,
+        available_at=available_at,
+        created_at=now,
+    ))
+
+
+def claim_event(db):
+    """
+    Захватывает самое раннее готовое к обработке событие (FOR UPDATE SKIP LOCKED):
+    строка остается заблокированной до конца транзакции, другие обработчики ее пропускают.
+    """
+    return (
+        db.query(WebhookEvent)
+        .filter(WebhookEvent.status == PENDING, WebhookEvent.available_at <= datetime.now(TIMEZONE))
+        .order_by(WebhookEvent.id)
+        .with_for_update(skip_locked=True)
+        .first()
+    )
+
+
+def claim_duplicates(db, item):
+    """
+    Захватывает остальные ожидающие события того же типа по той же сделке, включая еще
+    не созревшие: состояние сделки запрашивается после их поступления, поэтому они уже учтены.
+    """
+    if item.event not in COALESCED_EVENTS or item.deal_id is None:
+        return []
+    return (
+        db.query(WebhookEvent)
+        .filter(
+            WebhookEvent.status == PENDING,
+            WebhookEvent.event == item.event,
+            WebhookEvent.deal_id == item.deal_id,
+            WebhookEvent.id != item.id,
+        )
+        .with_for_update(skip_locked=True)
+        .all()
+    )
+
+
+def mark_done(item):
+    item.status = DONE
+    item.attempts += 1
+    item.processed_at = datetime.now(TIMEZONE)
+    item.last_error = None
+
+
+def mark_failed(item, error):
+    """
+    Откладывает событие для повтора с экспоненциальной задержкой; после
+    WEBHOOK_MAX_ATTEMPTS попыток событие остается в очереди со статусом failed.
+    """
+    item.attempts += 1
+    item.last_error = error
+    if item.attempts >= WEBHOOK_MAX_ATTEMPTS:
+        item.status = FAILED
+    else:
+        delay = WEBHOOK_RETRY_BASE_SECONDS * 2 ** (item.attempts - 1)
+        item.available_at = datetime.now(TIMEZONE) + timedelta(seconds=delay)
+
+
+def purge_processed_events():
+    """
+    Удаляет обработанные события старше WEBHOOK_EVENT_RETENTION_DAYS дней.
+    Неудавшиеся события остаются для разбора.
+    """
+    db = next(get_db())
+    try:
+        horizon = datetime.now(TIMEZONE) - timedelta(days=WEBHOOK_EVENT_RETENTION_DAYS)
+        deleted = (
+            db.query(WebhookEvent)
+            .filter(WebhookEvent.status == DONE, WebhookEvent.processed_at < horizon)
+            .delete(synchronize_session=False)
+        )
+        db.commit()
+        print(f"Очередь событий: удалено обработанных событий {deleted}.")
+    finally:
+        db.close()
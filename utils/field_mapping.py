@@ -0,0 +1,155 @@
+from datetime import datetime
+
+import pytz
+
+TIMEZONE = pytz.timezone('Europe/Moscow')
+
+# Операторы фильтров Bitrix24 в порядке разбора (двухсимвольные раньше односимвольных)
+FILTER_OPERATORS = ('>=', '<=', '>', '<', '!', '=')
+
+
+def parse_datetime(value):
+    """
+    Разбирает дату Bitrix24 (2024-05-01T10:00:00+03:00 или 2024-05-01T10:00:00+0300).
+    """
+    if isinstance(value, datetime):
+        return value
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        return datetime.strptime(value, '%Y-%m-%dT%H:%M:%S%z')
+
+
+def convert_value(value, column_type):
+    """
+    Преобразует значение поля API к типу колонки.
+    Флаги Bitrix24 (Y/N) хранятся как bool, пустые значения - как NULL.
+    """
+    if value in (None, ''):
+        return None
+    if column_type is datetime:
+        return parse_datetime(value)
+    if column_type is bool:
+        return value in ('Y', True)
+    return column_type(value)
+
+
+def record_to_row(record, fields):
+    """
+    Преобразует запись из ответа API в значения колонок по карте полей: поле API -> (колонка, тип).
+    """
+    return {
+        column: convert_value(record.get(field), column_type)
+        for field, (column, column_type) in fields.items()
+    }
+
+
+def row_to_record(row, fields):
+    """
+    Преобразует запись таблицы обратно в формат ответа API (строковые ID, Y/N, даты ISO 8601).
+    """
+    record = {}
+    for field, (column, column_type) in fields.items():
+        value = getattr(row, column)
+        if value is None:
+            record[field] = None
+        elif column_type is datetime:
+            record[field] = value.astimezone(TIMEZONE).isoformat(timespec='seconds')
+        elif column_type is bool:
+            record[field] = 'Y' if value else 'N'
+        else:
+            record[field] = str(value)
+    return record
+
+
+def split_filter_key(key):
+    """
+    Разделяет ключ фильтра Bitrix24 на оператор и поле: '>=END_TIME' -> ('>=', 'END_TIME').
+    """
+    for operator in FILTER_OPERATORS:
+        if key.startswith(operator):
+            return operator, key[len(operator):]
+    return '', key
+
+
+def api_filter_conditions(model, fields, api_filter):
+    """
+    Преобразует фильтр в формате Bitrix24 ({'>=END_TIME': ..., 'TYPE_ID': 2, ...}) в список условий SQLAlchemy.
+    """
+    conditions = []
+    for key, value in (api_filter or {}).items():
+        operator, field = split_filter_key(key)
+
+        if field not in fields:
+            raise ValueError(f"Поле {field} не поддерживается фильтром локальной таблицы.")
+
+        column_name, column_type = fields[field]
+        column = getattr(model, column_name)
+
+        if isinstance(value, (list, tuple, set)):
+            values = [convert_value(item, column_type) for item in value]
+            condition = column.in_(values)
+            conditions.append(~condition if operator == '!' else condition)
+            continue
+
+        value = convert_value(value, column_type)
+        if operator in ('', '='):
+            conditions.append(column.is_(None) if value is None else column == value)
+        elif operator == '!':
+            conditions.append(column.isnot(None) if value is None else column != value)
+        elif operator == '>=':
+            conditions.append(column >= value)
+        elif operator == '<=':
+            conditions.append(column <= value)
+        elif operator == '>':
+            conditions.append(column > value)
+        elif operator == '<':
+            conditions.append(column < value)
+
+    return conditions
+
+
+def apply_api_filter(query, model, fields, api_filter):
+    """
+    Применяет к запросу SQLAlchemy фильтр в формате Bitrix24,
+    чтобы локальные таблицы можно было запрашивать теми же параметрами, что и API.
+    """
+    return query.filter(*api_filter_conditions(model, fields, api_filter))
+
+
+def match_api_filter(record, fields, api_filter):
+    """
+    Проверяет, подходит ли запись в формате API под фильтр в формате Bitrix24.
+    Используется для фильтрации уже загруженных записей в памяти.
+    """
+    for key, value in (api_filter or {}).items():
+        operator, field = split_filter_key(key)
+        column_type = fields[field][1]
+        actual = convert_value(record.get(field), column_type)
+
+        if isinstance(value, (list, tuple, set)):
+            matched = actual in [convert_value(item, column_type) for item in value]
+            if matched == (operator == '!'):
+                return False
+            continue
+
+        expected = convert_value(value, column_type)
+        if operator in ('', '='):
+            matched = actual == expected
+        elif operator == '!':
+            matched = actual != expected
+        elif actual is None:
+            matched = False
+        elif operator == '>=':
+            matched = actual >= expected
+        elif operator == '<=':
+            matched = actual <= expected
+        elif operator == '>':
+            matched = actual > expected
+        else:
+            matched = actual < expected
+
+        if not matched:
+            return False
+
+    return True
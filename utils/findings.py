@@ -0,0 +1,148 @@
+import csv
+import json
+import os
+import threading
+from datetime import datetime
+
+from sqlalchemy.dialects.postgresql import insert
+
+from config import FINDINGS_SINKS, FINDINGS_FILE
+from database import get_db
+from metrics import CHECK_ROWS_FLAGGED, current_check
+from .models import Finding
+from .field_mapping import TIMEZONE
+from .sheet_dedup import row_hash
+from .google_sheets import write_to_sheet
+
+# Столбцы строки нарушения (в том же порядке она записывается в таблицу)
+ROW_COLUMNS = ['date', 'source', 'entity_id', 'title', 'status', 'responsible_name', 'link', 'remark']
+
+# Количество нарушений в одном INSERT
+INSERT_CHUNK_SIZE = 500
+
+
+def _to_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def save_findings(db, rows, responsible_ids, entity_type):
+    """
+    Записывает нарушения в таблицу finding одним INSERT на часть.
+    Повторно найденное нарушение (тот же отпечаток) не дублируется, у него обновляется last_seen_at.
+    Коммит выполняет вызывающий код.
+    """
+    now = datetime.now(TIMEZONE)
+    check_name = current_check()
+
+    records = {}
+    for row, responsible_id in zip(rows, responsible_ids):
+        # Дата строки в отпечаток не входит: повторная находка того же нарушения обновляет запись
+        fingerprint = row_hash([None, check_name] + list(row[1:]))
+        records[fingerprint] = {
+            'fingerprint': fingerprint,
+            'check_name': check_name,
+            'entity_type': entity_type if _to_int(row[2]) is not None else None,
+            'entity_id': _to_int(row[2]),
+            'responsible_id': _to_int(responsible_id),
+            'responsible_name': row[5],
+            'title': str(row[3]),
+            'status': str(row[4]),
+            'link': row[6],
+            'remark': row[7],
+            'found_at': now,
+            'last_seen_at': now,
+        }
+
+    values = list(records.values())
+    for i in range(0, len(values), INSERT_CHUNK_SIZE):
+        statement = insert(Finding).values(values[i:i + INSERT_CHUNK_SIZE])
+        statement = statement.on_conflict_do_update(
+            index_elements=[Finding.fingerprint],
+            set_={'last_seen_at': statement.excluded.last_seen_at}
+        )
+        db.execute(statement)
+
+
+class SheetSink:
+    """
+    Проекция нарушений в Google Sheets (строки накапливаются до конца запуска).
+    """
+
+    def emit(self, rows):
+        write_to_sheet(rows)
+
+
+class FileSink:
+    """
+    Проекция нарушений в локальный файл: CSV или JSON Lines (по расширению файла).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def emit(self, rows):
+        check_name = current_check()
+        with self.lock:
+            new_file = not os.path.exists(self.path)
+            with open(self.path, 'a', encoding='utf-8', newline='') as file:
+                if self.path.endswith('.csv'):
+                    writer = csv.writer(file)
+                    if new_file:
+                        writer.writerow(['check'] + ROW_COLUMNS)
+                    writer.writerows([check_name] + list(row) for row in rows)
+                else:
+                    for row in rows:
+                        record = {'check': check_name, **dict(zip(ROW_COLUMNS, row))}
+                        file.write(json.dumps(record, ensure_ascii=False, default=str) + '\n')
+
+
+def build_sinks(names):
+    """
+    Проекции из настройки FINDINGS_SINKS: sheets, file.
+    """
+    sinks = []
+    for name in (name.strip() for name in names.split(',')):
+        if name == 'sheets':
+            sinks.append(SheetSink())
+        elif name == 'file':
+            sinks.append(FileSink(FINDINGS_FILE))
+        elif name:
+            raise ValueError(f"Неизвестный приемник нарушений: {name}")
+    return sinks
+
+
+sinks = build_sinks(FINDINGS_SINKS)
+
+
+def report_findings(rows, responsible_ids=None, entity_type='deal'):
+    """
+    Сохраняет нарушения, найденные проверкой. rows - строки в формате таблицы
+    (дата, источник, ID сущности, название, статус, ответственный, ссылка, примечание),
+    responsible_ids - ID ответственных в том же порядке, entity_type - тип сущности в третьем столбце.
+
+    Основное хранилище - таблица finding в Postgres; Google Sheets и файл являются
+    проекциями, и их недоступность не приводит к потере нарушений.
+    """
+    if not rows:
+        return
+    CHECK_ROWS_FLAGGED.labels(current_check()).inc(len(rows))
+
+    db = next(get_db())
+    try:
+        save_findings(db, rows, responsible_ids or [None] * len(rows), entity_type)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+    for sink in sinks:
+        try:
+            sink.emit(rows)
+        except Exception as e:
+            print(f"Ошибка при записи нарушений в {type(sink).__name__}: {e}")
@@ -0,0 +1,43 @@
+import pandas as pd
+
+from .field_mapping import TIMEZONE
+
+
+def to_frame(records, columns):
+    """
+    Преобразует записи ответа API (список словарей) в таблицу pandas с заданными столбцами.
+    Отсутствующие в записи поля становятся пустыми значениями.
+    """
+    return pd.DataFrame.from_records(
+        [{column: record.get(column) for column in columns} for record in records],
+        columns=columns,
+    )
+
+
+def parse_times(values):
+    """
+    Разбирает столбец дат Bitrix24 целиком (2024-05-01T10:00:00+03:00 или +0300) в время UTC.
+    Неразборчивые и пустые значения становятся NaT.
+    """
+    return pd.to_datetime(values, utc=True, format='ISO8601', errors='coerce')
+
+
+def to_timestamp(moment):
+    """
+    Момент времени (datetime с часовым поясом) в виде, сравнимом со столбцами из parse_times.
+    """
+    return pd.Timestamp(moment).tz_convert('UTC')
+
+
+def local_hours(times):
+    """
+    Часы столбца времени по Москве (рабочее время проверок задано по Москве).
+    """
+    return times.dt.tz_convert(TIMEZONE.zone).dt.hour
+
+
+def local_strings(times, fmt='%Y-%m-%d %H:%M:%S'):
+    """
+    Столбец времени в виде строк по Москве.
+    """
+    return times.dt.tz_convert(TIMEZONE.zone).dt.strftime(fmt)
@@ -1,17 +1,99 @@
+import csv
+import gzip
+import os
+import random
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timedelta
+
 import gspread
 from oauth2client.service_account import ServiceAccountCredentials
-from config import SHEET_NAME, WORKSHEET_NAME, CREDENTIALS_FILE
+from config import (
+    SHEET_NAME,
+    WORKSHEET_NAME,
+    CREDENTIALS_FILE,
+    SHEET_APPEND_CHUNK_SIZE,
+    SHEET_MAX_RETRIES,
+    SHEET_BACKOFF_BASE,
+    SHEET_BACKOFF_MAX,
+    SHEET_PARTITION_FORMAT,
+    SHEET_RETENTION_DAYS,
+    SHEET_ARCHIVE_DIR,
+)
+from metrics import SHEET_WRITE_LATENCY, SHEET_ROWS_WRITTEN, current_check, timed
+from database import get_db
+from .sheet_dedup import claim_new_rows, rebuild_dedup_index, dedup_index_ready, drop_dedup_index
+from .field_mapping import TIMEZONE
+
+# Статусы Google Sheets API, при которых запись можно повторить (429 - превышена квота записи)
+RETRYABLE_STATUSES = (429, 500, 502, 503)
+
+# Первичное построение индекса выполняет только один поток
+_rebuild_lock = threading.Lock()
+
+# Авторизованный клиент и открытые листы переиспользуются между записями
+_spreadsheet = None
+_worksheets = {}
+_client_lock = threading.Lock()
+
+def get_spreadsheet():
+    """
+    Авторизация и открытие таблицы. Клиент авторизуется один раз за время работы процесса,
+    токен обновляется автоматически.
+    """
+    global _spreadsheet
+    with _client_lock:
+        if _spreadsheet is None:
+            scope = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
+            credentials = ServiceAccountCredentials.from_json_keyfile_name(CREDENTIALS_FILE, scope)
+            _spreadsheet = gspread.authorize(credentials).open(SHEET_NAME)
+        return _spreadsheet
+
+def worksheet_title(moment=None):
+    """
+    Имя листа-раздела для момента moment (по умолчанию - текущего), например "Отчет 2024-05".
+    Если SHEET_PARTITION_FORMAT пуст, все строки пишутся в WORKSHEET_NAME.
+    """
+    if not SHEET_PARTITION_FORMAT:
+        return WORKSHEET_NAME
+    moment = moment or datetime.now(TIMEZONE)
+    return f"{WORKSHEET_NAME} {moment.strftime(SHEET_PARTITION_FORMAT)}"
+
+def partition_start(title):
+    """
+    Начало периода листа-раздела по его имени или None, если лист не является разделом.
+    """
+    prefix = f"{WORKSHEET_NAME} "
+    if not SHEET_PARTITION_FORMAT or not title.startswith(prefix):
+        return None
+    try:
+        return datetime.strptime(title[len(prefix):], SHEET_PARTITION_FORMAT)
+    except ValueError:
+        return None
 
 # Авторизация и получение листа Google Sheets
-def get_google_sheet():
+def get_google_sheet(title=None):
     """
-    Авторизация и подключение к Google Sheets.
+    Лист title (по умолчанию - текущий раздел). Отсутствующий раздел создается
+    с заголовком, скопированным из основного листа WORKSHEET_NAME.
     """
-    scope = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
-    credentials = ServiceAccountCredentials.from_json_keyfile_name(CREDENTIALS_FILE, scope)
-    client = gspread.authorize(credentials)
-    sheet = client.open(SHEET_NAME).worksheet(WORKSHEET_NAME)
-    return sheet
+    title = title or worksheet_title()
+    spreadsheet = get_spreadsheet()
+    with _client_lock:
+        if title not in _worksheets:
+            try:
+                _worksheets[title] = spreadsheet.worksheet(title)
+            except gspread.exceptions.WorksheetNotFound:
+                header = spreadsheet.worksheet(WORKSHEET_NAME).row_values(1)
+                sheet = spreadsheet.add_worksheet(title=title, rows=1, cols=max(len(header), 1))
+                if header:
+                    sheet.append_row(header, value_input_option='RAW')
+                print(f"Создан лист {title}.")
+                _worksheets[title] = sheet
+        return _worksheets[title]
 
 def read_existing_rows(sheet):
     """
@@ -21,33 +103,189 @@ def read_existing_rows(sheet):
     # Пропускаем заголовки, если они есть
     return existing_rows[1:] if existing_rows else []
 
+def append_rows_with_retry(sheet, rows):
+    """
+    Добавляет строки в лист, повторяя запрос с экспоненциальной задержкой,
+    если Google ограничил запись (429) или временно недоступен.
+    """
+    for attempt in range(SHEET_MAX_RETRIES + 1):
+        try:
+            sheet.append_rows(rows, value_input_option='RAW')
+            return
+        except gspread.exceptions.APIError as e:
+            status = getattr(e.response, 'status_code', None)
+            if status not in RETRYABLE_STATUSES or attempt == SHEET_MAX_RETRIES:
+                raise
+            delay = min(SHEET_BACKOFF_MAX, SHEET_BACKOFF_BASE * 2 ** attempt) + random.uniform(0, 1)
+            print(f"Google Sheets ограничил запись ({status}). Повтор через {delay:.1f} с.")
+            time.sleep(delay)
+
+
+class SheetWriter:
+    """
+    Накопитель строк для записи в таблицу за один запуск проверок.
+    Проверки добавляют строки, а в конце запуска они записываются одним append_rows
+    (частями по SHEET_APPEND_CHUNK_SIZE строк, если их много).
+
+    После flush накопитель закрыт: проверка, которая не уложилась в таймаут и продолжает
+    работать в фоне с копией контекста запуска, записывает свои строки сразу.
+    """
+
+    def __init__(self):
+        self.entries = []  # (проверка, строка)
+        self.closed = False
+        self.lock = threading.Lock()
+
+    def add(self, rows):
+        check = current_check()
+        with self.lock:
+            if not self.closed:
+                self.entries.extend((check, row) for row in rows)
+                return
+        with timed(SHEET_WRITE_LATENCY):
+            _write_new_rows([(check, row) for row in rows])
+
+    def flush(self):
+        with self.lock:
+            entries, self.entries = self.entries, []
+            self.closed = True
+        if entries:
+            with timed(SHEET_WRITE_LATENCY):
+                _write_new_rows(entries)
+
+
+# Накопитель текущего запуска (по аналогии с кэшем запросов Bitrix24)
+_run_writer = ContextVar('sheet_writer', default=None)
+
+
+@contextmanager
+def run_sheet_writer():
+    """
+    Собирает строки всех проверок внутри блока with и записывает их в таблицу при выходе.
+    """
+    writer = SheetWriter()
+    token = _run_writer.set(writer)
+    try:
+        yield writer
+    finally:
+        _run_writer.reset(token)
+        # Нарушения уже сохранены в базе, поэтому ошибка записи в таблицу не прерывает запуск
+        try:
+            writer.flush()
+        except Exception as e:
+            print(f"Ошибка при записи строк в Google Sheets: {e}")
+
 def write_to_sheet(data):
     """
     Запись данных в Google Sheets в нужном формате, если таких записей еще нет.
+    Во время запуска проверок строки накапливаются и записываются одним запросом в конце запуска.
     """
-    sheet = get_google_sheet()
-
-    # Читаем уже существующие записи
-    existing_rows = read_existing_rows(sheet)
-    
-    # Преобразуем существующие данные в набор для быстрого поиска
-    existing_entries = set(
-        tuple(row[1:]) for row in existing_rows
-    )
-
-    rows_to_write = []
-    
-    # Проверяем каждую новую строку
-    for row in data:
-        # Преобразуем новую запись в формат для сравнения
-        new_entry = tuple(row[1:])  # Пропускаем первый столбец (дату)
-
-        if new_entry not in existing_entries:
-            rows_to_write.append(row)
-
-    # Записываем только новые строки
-    if rows_to_write:
-        sheet.append_rows(rows_to_write, value_input_option='RAW')
-    else:
+    writer = _run_writer.get()
+    if writer is not None:
+        writer.add(data)
+        return
+    with timed(SHEET_WRITE_LATENCY):
+        _write_new_rows([(current_check(), row) for row in data])
+
+def _write_new_rows(entries):
+    """
+    Добавляет в лист строки из entries (пары проверка, строка), которых в нем еще нет.
+    Уже записанные строки определяются по индексу хэшей в базе, а не чтением всего листа.
+    Каждая часть фиксируется в индексе только после успешной записи в лист.
+    """
+    # Все строки одной записи попадают в один раздел, даже если запись пришлась на смену периода
+    title = worksheet_title()
+    ensure_dedup_index(title)
+    sheet = get_google_sheet(title)
+    written = 0
+
+    for i in range(0, len(entries), SHEET_APPEND_CHUNK_SIZE):
+        chunk = entries[i:i + SHEET_APPEND_CHUNK_SIZE]
+        check_by_row = {id(row): check for check, row in chunk}
+
+        db = next(get_db())
+        try:
+            rows_to_write = claim_new_rows(db, [row for _, row in chunk], title)
+            if rows_to_write:
+                append_rows_with_retry(sheet, rows_to_write)
+                for check, count in Counter(check_by_row[id(row)] for row in rows_to_write).items():
+                    SHEET_ROWS_WRITTEN.labels(check).inc(count)
+                written += len(rows_to_write)
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    if not written:
         print("Нет новых данных для записи.")
-        
\ No newline at end of file
+    else:
+        print(f"Записано строк в таблицу: {written}")
+
+def ensure_dedup_index(title):
+    """
+    Строит индекс дедупликации по содержимому листа title, если он еще не построен.
+    Для нового раздела это чтение одного заголовка.
+    """
+    with _rebuild_lock:
+        db = next(get_db())
+        try:
+            if not dedup_index_ready(db, title):
+                rebuild_dedup_index(db, title, read_existing_rows(get_google_sheet(title)))
+                db.commit()
+        finally:
+            db.close()
+
+def rebuild_sheet_dedup_index(title=None):
+    """
+    Перестраивает индекс дедупликации по текущему содержимому листа (например, после ручной правки листа).
+    По умолчанию перестраивается индекс текущего раздела.
+    """
+    title = title or worksheet_title()
+    with _rebuild_lock:
+        db = next(get_db())
+        try:
+            rebuild_dedup_index(db, title, read_existing_rows(get_google_sheet(title)))
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+def archive_old_partitions():
+    """
+    Выгружает разделы, период которых начался раньше горизонта хранения SHEET_RETENTION_DAYS,
+    в сжатые CSV-файлы в SHEET_ARCHIVE_DIR, удаляет их из таблицы и из индекса дедупликации.
+    """
+    if not SHEET_PARTITION_FORMAT:
+        return
+
+    # Раздел архивируется, только если он целиком старше раздела, в который попадает горизонт
+    horizon = partition_start(worksheet_title(datetime.now(TIMEZONE) - timedelta(days=SHEET_RETENTION_DAYS)))
+    spreadsheet = get_spreadsheet()
+
+    for sheet in spreadsheet.worksheets():
+        start = partition_start(sheet.title)
+        if start is None or start >= horizon:
+            continue
+
+        os.makedirs(SHEET_ARCHIVE_DIR, exist_ok=True)
+        path = os.path.join(SHEET_ARCHIVE_DIR, f"{sheet.title}.csv.gz")
+        rows = sheet.get_all_values()
+        with gzip.open(path, 'wt', encoding='utf-8', newline='') as archive:
+            csv.writer(archive).writerows(rows)
+
+        spreadsheet.del_worksheet(sheet)
+        with _client_lock:
+            _worksheets.pop(sheet.title, None)
+
+        db = next(get_db())
+        try:
+            drop_dedup_index(db, sheet.title)
+            db.commit()
+        finally:
+            db.close()
+
+        print(f"Лист {sheet.title} перенесен в архив {path} ({len(rows)} строк).")
@@ -1,4 +1,5 @@
-from sqlalchemy import Column, Integer, String, Boolean
+from sqlalchemy import Column, Integer, BigInteger, String, Text, Boolean, DateTime, Index
+from sqlalchemy.dialects.postgresql import JSONB
 from database import Base  # Импортируем Base из database.py
 
 # Определяем модели таблиц базы данных
@@ -6,17 +7,132 @@ class DiffAssignmentID(Base):
     __tablename__ = 'diff_assigment_id'
 
     deal_id = Column(Integer, primary_key=True, index=True)
-    fixed_time = Column(String)
+    fixed_time = Column(DateTime(timezone=True))
     checked = Column(Boolean)
 
+    __table_args__ = (
+        Index('ix_diff_assigment_id_checked_fixed_time', 'checked', 'fixed_time'),
+    )
+
 class AllCreatedDeal(Base):
     __tablename__ = 'all_created_deal'
 
     deal_id = Column(Integer, primary_key=True, index=True)
     contact_id = Column(Integer)
-    created_time = Column(String)
+    created_time = Column(DateTime(timezone=True), index=True)
 
 class DelDealsContact(Base):
     __tablename__ = 'del_deals_contact'
 
     deal_id = Column(Integer, primary_key=True, index=True)
+
+class BitrixUser(Base):
+    __tablename__ = 'bitrix_user'
+
+    user_id = Column(Integer, primary_key=True, index=True)
+    name = Column(String)
+    last_name = Column(String)
+    refreshed_at = Column(DateTime(timezone=True), index=True)
+
+class BitrixDeal(Base):
+    __tablename__ = 'bitrix_deal'
+
+    deal_id = Column(Integer, primary_key=True, index=True)
+    contact_id = Column(Integer)
+    company_id = Column(Integer)
+    assigned_by_id = Column(Integer, index=True)
+    created_by_id = Column(Integer)
+    category_id = Column(Integer)
+    stage_id = Column(String)
+    title = Column(String)
+    date_create = Column(DateTime(timezone=True))
+    closedate = Column(DateTime(timezone=True))
+    date_modify = Column(DateTime(timezone=True), index=True)
+
+class BitrixActivity(Base):
+    __tablename__ = 'bitrix_activity'
+
+    activity_id = Column(Integer, primary_key=True, index=True)
+    owner_id = Column(Integer)
+    owner_type_id = Column(Integer)
+    type_id = Column(Integer)
+    direction = Column(Integer)
+    completed = Column(Boolean)
+    responsible_id = Column(Integer)
+    subject = Column(String)
+    start_time = Column(DateTime(timezone=True))
+    end_time = Column(DateTime(timezone=True))
+    deadline = Column(DateTime(timezone=True))
+    created = Column(DateTime(timezone=True))
+    last_updated = Column(DateTime(timezone=True), index=True)
+
+    __table_args__ = (
+        Index('ix_bitrix_activity_owner', 'owner_type_id', 'owner_id', 'type_id'),
+        Index('ix_bitrix_activity_end_time', 'type_id', 'completed', 'end_time'),
+        Index('ix_bitrix_activity_deadline', 'completed', 'deadline'),
+    )
+
+class SyncState(Base):
+    __tablename__ = 'sync_state'
+
+    name = Column(String, primary_key=True)
+    watermark = Column(DateTime(timezone=True))
+
+class SheetRowHash(Base):
+    __tablename__ = 'sheet_row_hash'
+
+    worksheet = Column(String, primary_key=True)
+    row_hash = Column(String(64), primary_key=True)
+    created_at = Column(DateTime(timezone=True))
+
+class Finding(Base):
+    __tablename__ = 'finding'
+
+    id = Column(BigInteger, primary_key=True, autoincrement=True)
+    fingerprint = Column(String(64), nullable=False, unique=True)
+    check_name = Column(String, nullable=False, index=True)
+    entity_type = Column(String)
+    entity_id = Column(Integer)
+    responsible_id = Column(Integer, index=True)
+    responsible_name = Column(String)
+    title = Column(String)
+    status = Column(String)
+    link = Column(String)
+    remark = Column(String)
+    found_at = Column(DateTime(timezone=True), nullable=False, index=True)
+    last_seen_at = Column(DateTime(timezone=True), nullable=False)
+
+    __table_args__ = (
+        Index('ix_finding_entity', 'entity_type', 'entity_id'),
+    )
+
+class WebhookEvent(Base):
+    __tablename__ = 'webhook_event'
+
+    id = Column(BigInteger, primary_key=True, autoincrement=True)
+    event = Column(String)
+    deal_id = Column(Integer)
+    payload = Column(JSONB, nullable=False)
+    status = Column(String, nullable=False, default='pending')
+    attempts = Column(Integer, nullable=False, default=0)
+    available_at = Column(DateTime(timezone=True), nullable=False)
+    created_at = Column(DateTime(timezone=True), nullable=False)
+    processed_at = Column(DateTime(timezone=True))
+    last_error = Column(Text)
+
+    __table_args__ = (
+        Index('ix_webhook_event_pending', 'status', 'available_at'),
+        Index('ix_webhook_event_deal', 'deal_id', 'event', 'status'),
+    )
+
+class DealCheckState(Base):
+    __tablename__ = 'deal_check_state'
+
+    deal_id = Column(Integer, primary_key=True)
+    check_name = Column(String, primary_key=True)
+    status = Column(String, nullable=False)
+    updated_at = Column(DateTime(timezone=True), nullable=False)
+
+    __table_args__ = (
+        Index('ix_deal_check_state_check_status', 'check_name', 'status'),
+    )
@@ -0,0 +1,165 @@
+from sqlalchemy import and_, or_
+
+from bitrix24_api import iter_list
+from database import get_db
+from .models import BitrixActivity, BitrixDeal
+from .field_mapping import api_filter_conditions, match_api_filter, split_filter_key, row_to_record
+from .activity_store import ACTIVITY_FIELDS
+from .deal_mirror import DEAL_FIELDS
+
+# Операторы, задающие временное окно; остальные условия фильтра считаются общими
+RANGE_OPERATORS = ('>=', '<=', '>', '<')
+
+
+def split_window(api_filter):
+    """
+    Разделяет фильтр на общую часть (равенства) и временное окно (условия с >=, <=, >, <).
+    """
+    base = {}
+    window = {}
+    for key, value in api_filter.items():
+        operator, _ = split_filter_key(key)
+        if operator in RANGE_OPERATORS:
+            window[key] = value
+        else:
+            base[key] = value
+    return base, window
+
+
+class TablePrefetch:
+    """
+    Предварительная выборка записей локальной таблицы на один запуск проверок.
+    Проверки объявляют свои фильтры, объявления с одинаковой общей частью объединяются
+    в один запрос (окна через OR), а каждая проверка получает из памяти записи своего окна.
+    Таблица и карта полей задаются в подклассах.
+    """
+
+    model = None
+    fields = None
+    label = None
+
+    def __init__(self):
+        self.declarations = {}  # имя -> (общая часть фильтра, окно)
+        self.groups = {}  # общая часть фильтра (ключ) -> загруженные записи
+        self.fetched = False
+
+    def declare(self, name, api_filter):
+        """
+        Объявляет выборку name с фильтром в формате списочного метода Bitrix24.
+        """
+        self.declarations[name] = split_window(api_filter)
+
+    @staticmethod
+    def _group_key(base):
+        return tuple(sorted((key, str(value)) for key, value in base.items()))
+
+    def fetch(self):
+        """
+        Выполняет по одному запросу к таблице на каждую группу объявлений с общей частью фильтра.
+        """
+        grouped = {}
+        for base, window in self.declarations.values():
+            entry = grouped.setdefault(self._group_key(base), (base, []))
+            entry[1].append(window)
+
+        db = next(get_db())
+        try:
+            for group_key, (base, windows) in grouped.items():
+                query = db.query(self.model).filter(
+                    *api_filter_conditions(self.model, self.fields, base)
+                )
+                window_conditions = [
+                    and_(*api_filter_conditions(self.model, self.fields, window))
+                    for window in windows if window
+                ]
+                # Если хотя бы одному объявлению нужны все записи, окно не ограничивает выборку
+                if window_conditions and len(window_conditions) == len(windows):
+                    query = query.filter(or_(*window_conditions))
+
+                self.groups[group_key] = [row_to_record(row, self.fields) for row in query.all()]
+        finally:
+            db.close()
+
+        self.fetched = True
+        print(f"Предварительная выборка {self.label}: {len(self.declarations)} объявлений, {len(grouped)} запросов.")
+
+    def view(self, name):
+        """
+        Записи объявления name, отфильтрованные по его собственному окну.
+        """
+        base, window = self.declarations[name]
+        records = self.groups.get(self._group_key(base), [])
+        return [record for record in records if match_api_filter(record, self.fields, window)]
+
+
+class ActivityPrefetch(TablePrefetch):
+    """
+    Предварительная выборка дел из bitrix_activity.
+    """
+
+    model = BitrixActivity
+    fields = ACTIVITY_FIELDS
+    label = 'дел'
+
+
+class DealPrefetch(TablePrefetch):
+    """
+    Предварительная выборка сделок из зеркала bitrix_deal.
+    """
+
+    model = BitrixDeal
+    fields = DEAL_FIELDS
+    label = 'сделок'
+
+
+class StageHistoryPrefetch:
+    """
+    Предварительная выборка истории стадий сделок из Bitrix24 на один запуск проверок.
+    Проверки объявляют списки сделок, история всех объявленных сделок загружается
+    одной постраничной выборкой, а каждая проверка получает записи своих сделок
+    в порядке от новых изменений к старым. Если выборка не удалась, view возвращает None,
+    и проверка загружает историю сама (ошибка относится к проверке, а не ко всему запуску).
+    """
+
+    METHOD = 'crm.stagehistory.list'
+
+    def __init__(self):
+        self.declarations = {}  # имя -> множество ID сделок
+        self.records = None
+        self.fetched = False
+
+    def declare(self, name, owner_ids):
+        """
+        Объявляет выборку name: история стадий сделок owner_ids.
+        """
+        self.declarations[name] = {str(owner_id) for owner_id in owner_ids}
+
+    def fetch(self):
+        """
+        Загружает историю стадий объединения всех объявленных сделок одним запросом.
+        """
+        owner_ids = sorted(set().union(*self.declarations.values()))
+        params = {
+            'entityTypeId': 2,  # Тип сущности: 2 - сделка
+            'filter': {'OWNER_ID': owner_ids},
+            'order': {'ID': 'DESC'},
+            'select': ['OWNER_ID', 'STAGE_ID', 'CREATED_TIME'],
+        }
+        try:
+            self.records = list(iter_list(self.METHOD, params, fast=True)) if owner_ids else []
+        except Exception as e:
+            print(f"Ошибка при предварительной выборке истории стадий: {e}")
+
+        self.fetched = True
+        print(f"Предварительная выборка истории стадий: {len(self.declarations)} объявлений, "
+              f"{1 if owner_ids else 0} запросов.")
+
+    def view(self, name):
+        """
+        Записи истории стадий сделок объявления name или None, если выборка не удалась.
+        """
+        if self.records is None:
+            return None
+        owner_ids = self.declarations[name]
+        return [record for record in self.records if str(record.get('OWNER_ID')) in owner_ids]
+
@@ -0,0 +1,81 @@
+import hashlib
+import json
+from datetime import datetime
+
+from sqlalchemy.dialects.postgresql import insert
+
+from .models import SheetRowHash, SyncState
+from .field_mapping import TIMEZONE
+
+# Количество хэшей в одном INSERT
+INSERT_CHUNK_SIZE = 1000
+
+
+def row_hash(row):
+    """
+    Хэш строки таблицы без первого столбца (даты записи).
+    Значения приводятся к строкам, как их возвращает Google Sheets.
+    """
+    values = [str(value) if value is not None else '' for value in row[1:]]
+    # Google Sheets не возвращает пустые ячейки в конце строки
+    while values and values[-1] == '':
+        values.pop()
+    return hashlib.sha256(json.dumps(values, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+
+def _state_name(worksheet):
+    return f"sheet_dedup:{worksheet}"
+
+
+def claim_new_rows(db, rows, worksheet):
+    """
+    Регистрирует хэши строк в индексе и возвращает строки, которых в листе еще не было.
+    Хэши становятся видимы другим потокам только после коммита, который вызывающий код
+    выполняет после успешной записи в лист; параллельная запись той же строки ждет этого коммита.
+    """
+    by_hash = {}
+    for row in rows:
+        by_hash.setdefault(row_hash(row), row)
+
+    now = datetime.now(TIMEZONE)
+    hashes = list(by_hash)
+    claimed = set()
+    for i in range(0, len(hashes), INSERT_CHUNK_SIZE):
+        statement = insert(SheetRowHash).values([
+            {'worksheet': worksheet, 'row_hash': value, 'created_at': now}
+            for value in hashes[i:i + INSERT_CHUNK_SIZE]
+        ]).on_conflict_do_nothing().returning(SheetRowHash.row_hash)
+        claimed.update(db.execute(statement).scalars())
+
+    return [row for value, row in by_hash.items() if value in claimed]
+
+
+def rebuild_dedup_index(db, worksheet, existing_rows):
+    """
+    Перестраивает индекс листа worksheet по его текущим строкам (без заголовка).
+    Коммит выполняет вызывающий код.
+    """
+    db.query(SheetRowHash).filter(SheetRowHash.worksheet == worksheet).delete()
+    claim_new_rows(db, existing_rows, worksheet)
+
+    state = db.get(SyncState, _state_name(worksheet))
+    if state is None:
+        state = SyncState(name=_state_name(worksheet))
+        db.add(state)
+    state.watermark = datetime.now(TIMEZONE)
+    print(f"Индекс дедупликации листа {worksheet} перестроен: {len(existing_rows)} строк.")
+
+
+def dedup_index_ready(db, worksheet):
+    """
+    True, если индекс листа уже построен.
+    """
+    return db.get(SyncState, _state_name(worksheet)) is not None
+
+
+def drop_dedup_index(db, worksheet):
+    """
+    Удаляет индекс листа worksheet (после архивации листа). Коммит выполняет вызывающий код.
+    """
+    db.query(SheetRowHash).filter(SheetRowHash.worksheet == worksheet).delete()
+    db.query(SyncState).filter(SyncState.name == _state_name(worksheet)).delete()
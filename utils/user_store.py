@@ -0,0 +1,161 @@
+import threading
+from datetime import datetime, timedelta
+
+import pytz
+from sqlalchemy.dialects.postgresql import insert
+
+from bitrix24_api import call_api
+from config import USER_DIRECTORY_TTL_HOURS
+from database import get_db
+from .models import BitrixUser
+
+TIMEZONE = pytz.timezone('Europe/Moscow')
+
+
+def format_user_name(name, last_name):
+    """
+    Имя пользователя в формате, который используется в отчетах.
+    """
+    return f"{name or ''} {last_name or ''}"
+
+
+class UserDirectory:
+    """
+    Справочник сотрудников Bitrix24: таблица bitrix_user, загружаемая в память при старте.
+    Имена отдаются из памяти, записи старше ttl обновляются фоновым заданием,
+    а изменения из вебхука применяются сразу.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.users = {}  # ID пользователя (строкой) -> (имя для отчета, время обновления)
+        self.loaded = False
+        self.lock = threading.Lock()
+
+    def load(self):
+        """
+        Загружает справочник из базы данных в память.
+        """
+        db = next(get_db())
+        try:
+            rows = db.query(BitrixUser).all()
+            with self.lock:
+                self.users = {
+                    str(row.user_id): (format_user_name(row.name, row.last_name), row.refreshed_at)
+                    for row in rows
+                }
+                self.loaded = True
+            print(f"Справочник пользователей загружен: {len(rows)} записей.")
+        except Exception as e:
+            print(f"Не удалось загрузить справочник пользователей: {e}")
+        finally:
+            db.close()
+
+    def resolve(self, user_ids):
+        """
+        Возвращает имена известных пользователей и список ID, которых нет в справочнике.
+        """
+        if not self.loaded:
+            self.load()
+
+        names = {}
+        missing = []
+        with self.lock:
+            for user_id in user_ids:
+                entry = self.users.get(str(user_id))
+                if entry:
+                    names[str(user_id)] = entry[0]
+                else:
+                    missing.append(user_id)
+        return names, missing
+
+    def store(self, users):
+        """
+        Сохраняет пользователей из ответа user.get в базу данных и в память.
+        """
+        if not users:
+            return
+
+        now = datetime.now(TIMEZONE)
+        values = [
+            {
+                'user_id': int(user['ID']),
+                'name': user.get('NAME'),
+                'last_name': user.get('LAST_NAME'),
+                'refreshed_at': now,
+            }
+            for user in users
+        ]
+
+        with self.lock:
+            for value in values:
+                self.users[str(value['user_id'])] = (format_user_name(value['name'], value['last_name']), now)
+
+        db = next(get_db())
+        try:
+            statement = insert(BitrixUser).values(values)
+            statement = statement.on_conflict_do_update(
+                index_elements=[BitrixUser.user_id],
+                set_={
+                    'name': statement.excluded.name,
+                    'last_name': statement.excluded.last_name,
+                    'refreshed_at': statement.excluded.refreshed_at,
+                }
+            )
+            db.execute(statement)
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            print(f"Не удалось сохранить пользователей в справочник: {e}")
+        finally:
+            db.close()
+
+    def fetch(self, user_ids):
+        """
+        Запрашивает пользователей в Bitrix24 и сохраняет их в справочник.
+        Возвращает полученные записи user.get.
+        """
+        fetched = []
+        unique_user_ids = list(set(user_ids))
+        batch_size = 50  # Ограничение на количество элементов в одном запросе (зависит от ограничений API)
+
+        for i in range(0, len(unique_user_ids), batch_size):
+            batch_ids = unique_user_ids[i:i + batch_size]
+            data = call_api('user.get', params={'ID': batch_ids}, http_method='POST')
+            if data and 'result' in data and data['result']:
+                fetched.extend(data['result'])
+            else:
+                print(f"Не удалось получить данные для пользователей: {batch_ids}")
+
+        self.store(fetched)
+        return fetched
+
+    def refresh_stale(self):
+        """
+        Обновляет записи, которые не обновлялись дольше ttl.
+        Запрашиваются только устаревшие пользователи, а не весь справочник.
+        """
+        if not self.loaded:
+            self.load()
+
+        threshold = datetime.now(TIMEZONE) - self.ttl
+        with self.lock:
+            stale_ids = [
+                user_id for user_id, (_, refreshed_at) in self.users.items()
+                if refreshed_at is None or refreshed_at < threshold
+            ]
+
+        if stale_ids:
+            print(f"Обновление справочника пользователей: {len(stale_ids)} записей.")
+            self.fetch(stale_ids)
+
+    def handle_event(self, user_id):
+        """
+        Обновляет пользователя по событию изменения из вебхука.
+        """
+        if user_id:
+            self.fetch([user_id])
+
+
+# Общий справочник для всего приложения
+user_directory = UserDirectory(timedelta(hours=USER_DIRECTORY_TTL_HOURS))
@@ -1,28 +1,20 @@
-from bitrix24_api import call_api
+from .user_store import user_directory, format_user_name
 
 def get_user_names(user_ids):
     """
     Функция для получения имен пользователей по их ID.
+    Имена берутся из справочника пользователей в памяти, в Bitrix24 запрашиваются только неизвестные ID.
     """
-    user_names = {}
     unique_user_ids = list(set(user_ids))
-    batch_size = 50  # Ограничение на количество элементов в одном запросе (зависит от ограничений API)
+    user_names, missing_user_ids = user_directory.resolve(unique_user_ids)
 
-    # Получаем данные о пользователях батчами по batch_size ID за один запрос
-    for i in range(0, len(unique_user_ids), batch_size):
-        batch_ids = unique_user_ids[i:i + batch_size]
-        params = {'ID': batch_ids}
-        data = call_api('user.get', params=params, http_method='POST')
-        
-        if data and 'result' in data and data['result']:
-            users = data['result']
-            for user in users:
-                user_id = user.get('ID')
-                user_names[user_id] = f"{user.get('NAME', '')} {user.get('LAST_NAME', '')}"
-        else:
-            print(f"Не удалось получить данные для пользователей: {batch_ids}")
-            # Если не удалось получить данные, сохраняем ID как fallback
-            for user_id in batch_ids:
-                user_names[user_id] = f"ID {user_id}"
+    if missing_user_ids:
+        fetched_users = user_directory.fetch(missing_user_ids)
+        for user in fetched_users:
+            user_names[user.get('ID')] = format_user_name(user.get('NAME'), user.get('LAST_NAME'))
+
+        # Если не удалось получить данные, сохраняем ID как fallback
+        for user_id in missing_user_ids:
+            user_names.setdefault(str(user_id), f"ID {user_id}")
 
     return user_names
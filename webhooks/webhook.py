@@ -5,7 +5,11 @@ from bitrix24_api import call_api
 import pytz
 from database import get_db  # Импортируем get_db из database.py
 from utils import *
+from utils.field_mapping import record_to_row
+from sqlalchemy import select, update, literal, DateTime, Boolean
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.orm import Session
+from metrics import render_metrics
 
 app = Flask(__name__)
 
@@ -27,82 +31,119 @@ def webhook():
     if application_token != APPLICATION_TOKEN:
         return jsonify({'status': 'forbidden', 'error': 'Invalid application token'}), 403
 
-    # Get the event type
-    event = data.get('event')
-
-    # Create a new session for database operations
+    # Persist the raw event in one insert and return right away; workers process the queue
     db = next(get_db())
-
     try:
-        # Process the event for adding a new deal
-        if event == 'ONCRMDEALADD':
-            deal_id = data.get('data[FIELDS][ID]')
-            
-            # Get deal data
-            deal_data = get_deal_data(deal_id)
-
-            # Get assigned, creator, and contact details
-            assigned_by_id = deal_data.get('ASSIGNED_BY_ID')
-            created_by_id = deal_data.get('CREATED_BY_ID')
-            contact_id = deal_data.get('CONTACT_ID')
-            created_time = datetime.now(pytz.timezone('Europe/Moscow')).isoformat()
-
-            if assigned_by_id and created_by_id:
-                # If there is a transfer of client, fix the time and add to diff_assigment_id table
-                if assigned_by_id != created_by_id:
-                    fixed_time = datetime.now(pytz.timezone('Europe/Moscow')).isoformat()
-                    # Check if the deal already exists in diff_assigment_id
-                    existing_diff = db.query(DiffAssignmentID).filter(DiffAssignmentID.deal_id == deal_id).first()
-                    if not existing_diff:
-                        new_diff_assignment = DiffAssignmentID(deal_id=deal_id, fixed_time=fixed_time, checked=False)
-                        db.add(new_diff_assignment)
-
-                # Add deal data to all_created_deal table
-                new_deal = AllCreatedDeal(deal_id=deal_id, contact_id=contact_id, created_time=created_time)
-                db.add(new_deal)
-
-            db.commit()
-
-        # Process the event for updating a deal
-        elif event == 'ONCRMDEALUPDATE':
-            deal_id = data.get('data[FIELDS][ID]')
-            
-            # Get deal data
-            deal_data = get_deal_data(deal_id)
-            assigned_by_id = deal_data.get('ASSIGNED_BY_ID')
-            created_by_id = deal_data.get('CREATED_BY_ID')
-            contact_id = deal_data.get('CONTACT_ID')
-
-            # Check conditions for adding to diff_assigment_id table
-            if assigned_by_id and created_by_id:
-                if assigned_by_id != created_by_id:
-                    # Check if the deal exists in all_created_deal
-                    existing_deal = db.query(AllCreatedDeal).filter(AllCreatedDeal.deal_id == deal_id).first()
-                    
-                    # If conditions are met and the deal does not exist in diff_assigment_id, record the time and add data
-                    if existing_deal:
-                        existing_diff = db.query(DiffAssignmentID).filter(DiffAssignmentID.deal_id == deal_id).first()
-                        if not existing_diff:
-                            fixed_time = datetime.now(pytz.timezone('Europe/Moscow')).isoformat()
-                            new_diff_assignment = DiffAssignmentID(deal_id=deal_id, fixed_time=fixed_time, checked=False)
-                            db.add(new_diff_assignment)
-
-            # If the deal has a contact_id, update the record in all_created_deal
-            if contact_id:
-                existing_contact = db.query(AllCreatedDeal).filter(AllCreatedDeal.deal_id == deal_id).first()
-                # If the record exists and the contact is different, update the contact_id
-                if existing_contact and existing_contact.contact_id != contact_id:
-                    existing_contact.contact_id = contact_id
-
-            db.commit()
-
+        enqueue_event(db, data.get('event'), data)
+        db.commit()
     except Exception as e:
         db.rollback()
         return jsonify({'status': 'error', 'message': str(e)}), 500
     finally:
         db.close()
 
-    return jsonify({'status': 'ok'})
+    return jsonify({'status': 'queued'})
+
+def process_event(db, event, data):
+    """
+    Applies a queued Bitrix24 event to the local tables.
+    Does not commit: the worker commits together with the queue status.
+    """
+    # Process deal add/update events: one statement per event
+    if event in ('ONCRMDEALADD', 'ONCRMDEALUPDATE'):
+        deal_id = int(data.get('data[FIELDS][ID]'))
+
+        # Get deal data
+        deal_data = get_deal_data(deal_id)
+        if not deal_data:
+            raise RuntimeError(f"Failed to get deal {deal_id}")
+
+        now = datetime.now(pytz.timezone('Europe/Moscow'))
+        db.execute(deal_event_statement(event, deal_id, deal_data, now))
+
+    # Process the event for deleting a deal
+    elif event == 'ONCRMDEALDELETE':
+        deal_id = data.get('data[FIELDS][ID]')
+        if deal_id:
+            delete_deal(db, deal_id)
+
+    # Process the event for deleting an activity (the incremental sync cannot see deletions)
+    elif event == 'ONCRMACTIVITYDELETE':
+        activity_id = data.get('data[FIELDS][ID]')
+        if activity_id:
+            delete_activity(db, activity_id)
+
+    # Process user add/update events to keep the user directory current
+    elif event in ('ONUSERADD', 'ONUSERUPDATE'):
+        user_id = data.get('data[ID]') or data.get('data[FIELDS][ID]')
+        user_directory.handle_event(user_id)
+
+def deal_event_statement(event, deal_id, deal_data, now):
+    """
+    Builds a single statement that applies a deal add/update event. Every write is an
+    INSERT ... ON CONFLICT (or a conditional UPDATE) inside a data-modifying CTE, so the
+    event costs one round trip and concurrent workers cannot hit a primary-key violation.
+    """
+    assigned_by_id = deal_data.get('ASSIGNED_BY_ID')
+    created_by_id = deal_data.get('CREATED_BY_ID')
+    contact_id = int(deal_data['CONTACT_ID']) if deal_data.get('CONTACT_ID') else None
+
+    # Keep the local deal mirror current
+    ctes = [deal_upsert_statement([record_to_row(deal_data, DEAL_FIELDS)]).cte('mirror')]
+
+    # A transfer of client: the deal is assigned to someone other than its creator
+    transferred = bool(assigned_by_id and created_by_id and assigned_by_id != created_by_id)
+
+    if event == 'ONCRMDEALADD':
+        if assigned_by_id and created_by_id:
+            # Fix the transfer time in diff_assigment_id unless it is already recorded
+            if transferred:
+                ctes.append(
+                    insert(DiffAssignmentID)
+                    .values(deal_id=deal_id, fixed_time=now, checked=False)
+                    .on_conflict_do_nothing(index_elements=[DiffAssignmentID.deal_id])
+                    .cte('diff')
+                )
+
+            # Add deal data to all_created_deal table
+            ctes.append(
+                insert(AllCreatedDeal)
+                .values(deal_id=deal_id, contact_id=contact_id, created_time=now)
+                .on_conflict_do_nothing(index_elements=[AllCreatedDeal.deal_id])
+                .cte('created')
+            )
+    else:
+        # Record the transfer only for deals tracked in all_created_deal
+        if transferred:
+            tracked = select(
+                AllCreatedDeal.deal_id,
+                literal(now, DateTime(timezone=True)),
+                literal(False, Boolean),
+            ).where(AllCreatedDeal.deal_id == deal_id)
+            ctes.append(
+                insert(DiffAssignmentID)
+                .from_select(['deal_id', 'fixed_time', 'checked'], tracked)
+                .on_conflict_do_nothing(index_elements=[DiffAssignmentID.deal_id])
+                .cte('diff')
+            )
+
+        # If the deal has a contact_id, update the record in all_created_deal when it changed
+        if contact_id:
+            ctes.append(
+                update(AllCreatedDeal)
+                .where(AllCreatedDeal.deal_id == deal_id, AllCreatedDeal.contact_id.is_distinct_from(contact_id))
+                .values(contact_id=contact_id)
+                .cte('contact')
+            )
+
+    # Data-modifying CTEs always run to completion, even though the outer query does not read them
+    return select(literal(1)).add_cte(*ctes)
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    # Prometheus scrape endpoint: API calls, sheet writes, DB transactions and checks
+    body, content_type = render_metrics()
+    return body, 200, {'Content-Type': content_type}
 
 def get_deal_data(deal_id):
     """
@@ -0,0 +1,71 @@
+import threading
+import traceback
+
+from config import WEBHOOK_WORKERS, WEBHOOK_POLL_SECONDS
+from database import get_db
+from metrics import WEBHOOK_EVENTS, WEBHOOK_EVENTS_COALESCED
+from utils.event_queue import claim_event, claim_duplicates, mark_done, mark_failed
+from .webhook import process_event
+
+
+def process_next_event():
+    """
+    Claims and processes one queued event. Returns False when the queue has nothing ready.
+    """
+    db = next(get_db())
+    try:
+        item = claim_event(db)
+        if item is None:
+            db.rollback()
+            return False
+
+        # Later updates of the same deal are collapsed into this one: the deal is fetched once
+        duplicates = claim_duplicates(db, item)
+
+        # The savepoint undoes a failed event's changes while the row lock is kept,
+        # so the attempt is recorded before another worker can claim the event
+        try:
+            with db.begin_nested():
+                process_event(db, item.event, item.payload)
+            mark_done(item)
+            for duplicate in duplicates:
+                mark_done(duplicate)
+            WEBHOOK_EVENTS.labels(item.event or 'unknown', 'done').inc()
+            if duplicates:
+                WEBHOOK_EVENTS_COALESCED.labels(item.event).inc(len(duplicates))
+        except Exception as e:
+            print(f"Failed to process webhook event {item.id} ({item.event}): {e}")
+            mark_failed(item, traceback.format_exc())
+            WEBHOOK_EVENTS.labels(item.event or 'unknown', item.status).inc()
+
+        db.commit()
+        return True
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+
+def worker_loop(stop):
+    """
+    Processes queued events until stop is set; sleeps while the queue is empty.
+    """
+    while not stop.is_set():
+        try:
+            if not process_next_event():
+                stop.wait(WEBHOOK_POLL_SECONDS)
+        except Exception as e:
+            print(f"Webhook worker error: {e}")
+            stop.wait(WEBHOOK_POLL_SECONDS)
+
+
+def start_workers(count=WEBHOOK_WORKERS):
+    """
+    Starts the webhook worker pool as daemon threads. Returns the stop event.
+    """
+    stop = threading.Event()
+    for index in range(count):
+        thread = threading.Thread(target=worker_loop, args=(stop,), name=f'webhook-worker-{index}', daemon=True)
+        thread.start()
+    return stop